@@ -1,8 +1,14 @@
 """ Encode and decode ASCII armored text.
 """
 import base64
+import json
+import mmap
+import os
+import re
 import textwrap
 
+from cache import write_atomic
+
 
 ARMOR_TYPES = {
     'message': ('-----BEGIN PFSE MESSAGE-----', '-----END PFSE MESSAGE-----'),
@@ -14,6 +20,10 @@ ARMOR_LOOKUP = {}
 for type_, (header, footer) in ARMOR_TYPES.items():
     ARMOR_LOOKUP[header] = type_
 
+CHUNK = 3 * 1024 * 1024  # Default streaming chunk size, in bytes (a multiple of 3 and 4).
+
+HEADER = re.compile(b'|'.join(re.escape(header.encode('ascii')) for header in ARMOR_LOOKUP))
+
 
 def armor(blob, type='message', width=80):
     """ Generate ASCII armored text.
@@ -50,3 +60,231 @@ def dearmor(text):
                 state = None
 
     return blobs
+
+
+class ArmorWriter(object):
+    """ File-like object that ASCII armors everything written to it.
+
+        Writes binary armored text to output, fixed-width lines at a time,
+        the same text armor() produces. close() writes the last line and
+        the footer, it does not close output.
+    """
+    def __init__(self, output, type='message', width=80):
+        header, self.footer = ARMOR_TYPES[type]
+        self.output = output
+        self.width = width
+        self.pending = b''
+        self.line = b''
+        self.lines = 0
+        output.write(header.encode('ascii') + b'\n')
+
+    def emit(self, text):
+        """ Write all complete lines of text, keep the rest.
+        """
+        text = self.line + text
+        width = self.width
+        n = len(text) - len(text) % width
+        if n:
+            self.output.write(b''.join(text[i:i + width] + b'\n' for i in range(0, n, width)))
+            self.lines += n // width
+        self.line = text[n:]
+
+    def write(self, blob):
+        data = self.pending + bytes(blob)
+        n = len(data) - len(data) % 3
+        self.pending = data[n:]
+        self.emit(base64.b64encode(data[:n]))
+        return len(blob)
+
+    def close(self):
+        self.emit(base64.b64encode(self.pending))
+        self.pending = b''
+        if self.line or not self.lines:
+            self.output.write(self.line + b'\n')
+        self.output.write(self.footer.encode('ascii'))
+
+
+class DearmorReader(object):
+    """ File-like object that decodes an ASCII armored block as it is read.
+
+        Reads binary armored text from input_, skipping everything up to the
+        first header (of the given type, if any), self.type is the type of
+        that block, or None when there is none.
+    """
+    def __init__(self, input_, type=None, chunk=CHUNK):
+        self.input_ = input_
+        self.chunk = chunk
+        self.carry = b''
+        self.buffer = b''
+        self.done = False
+        self.type = None
+        for line in input_:
+            for header, type_ in ARMOR_LOOKUP.items():
+                if header.encode('ascii') in line and type in [None, type_]:
+                    self.type = type_
+                    break
+            if self.type:
+                break
+        else:
+            self.done = True
+
+    def fill(self):
+        """ Decode the next chunk into the buffer.
+        """
+        raw = self.input_.read(self.chunk)
+        data = self.carry + raw.translate(None, b' \t\r\n')
+        # '-' is not in the base64 alphabet, it marks the footer.
+        end = data.find(b'-')
+        if end >= 0 or not raw:
+            self.done = True
+            data = data[:end] if end >= 0 else data
+            n = len(data)
+        else:
+            n = len(data) - len(data) % 4
+        self.carry = data[n:]
+        self.buffer += base64.b64decode(data[:n])
+
+    def read(self, n=-1):
+        while not self.done and (n < 0 or len(self.buffer) < n):
+            self.fill()
+        n = len(self.buffer) if n < 0 else n
+        blob, self.buffer = self.buffer[:n], self.buffer[n:]
+        return blob
+
+    def readinto(self, buffer):
+        blob = self.read(len(buffer))
+        buffer[:len(blob)] = blob
+        return len(blob)
+
+
+def armor_stream(input_, output, type='message', width=80, chunk=CHUNK):
+    """ ASCII armor a binary file into another, chunk by chunk.
+    """
+    writer = ArmorWriter(output, type, width)
+    blob = input_.read(chunk)
+    while blob:
+        writer.write(blob)
+        blob = input_.read(chunk)
+    writer.close()
+
+
+def dearmor_stream(input_, output, type=None, chunk=CHUNK):
+    """ Decode the first ASCII armored block of a file into another.
+
+        Returns the type of the block, None if there is none.
+    """
+    reader = DearmorReader(input_, type, chunk)
+    blob = reader.read(chunk)
+    while blob:
+        output.write(blob)
+        blob = reader.read(chunk)
+
+    return reader.type
+
+
+class Block(object):
+    """ An armored block in a bundle file, decoded only when read.
+    """
+    def __init__(self, path, type, offset, length):
+        self.path = path
+        self.type = type
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return f'Block({self.path!r}, {self.type!r}, {self.offset}, {self.length})'
+
+    def read(self):
+        """ Decode the block, recipes as text, like dearmor.
+        """
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            text = fh.read(self.length)
+
+        start = text.find(b'\n') + 1
+        stop = text.rfind(ARMOR_TYPES[self.type][1].encode('ascii'))
+        blob = base64.b64decode(text[start:stop].translate(None, b' \t\r\n'))
+        if self.type in ['recipe']:
+            return blob.decode()
+        return blob
+
+    def copy(self, output, chunk=CHUNK):
+        """ Decode the block into a binary file, chunk by chunk.
+        """
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            dearmor_stream(fh, output, self.type, chunk)
+
+
+class Bundle(object):
+    """ Index of the armored blocks in a (large) file.
+
+        The file is scanned once for block headers and footers, the index
+        of (type, byte offset, length) is kept beside it in path.idx and
+        reused for as long as the file is unchanged. When path.idx can not
+        be written the index is only kept in memory. Blocks are decoded
+        lazily, getting one costs only that block's decode.
+    """
+    def __init__(self, path, persist=True):
+        self.path = path
+        self.index_path = path + '.idx'
+        st = os.stat(path)
+        self.stamp = [st.st_size, st.st_mtime_ns]
+        self.index = None
+
+        if persist:
+            try:
+                with open(self.index_path, 'r') as fh:
+                    saved = json.load(fh)
+                if saved['stamp'] == self.stamp:
+                    self.index = saved['blocks']
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if self.index is None:
+            self.index = self.scan()
+            if persist:
+                try:
+                    self.save()
+                except OSError:
+                    pass
+
+    def scan(self):
+        """ Find every block in a single pass over the file.
+        """
+        index = []
+        if not self.stamp[0]:
+            return index
+
+        with open(self.path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while True:
+                match = HEADER.search(mm, pos)
+                if not match:
+                    break
+                type_ = ARMOR_LOOKUP[match.group().decode('ascii')]
+                footer = ARMOR_TYPES[type_][1].encode('ascii')
+                end = mm.find(footer, match.end())
+                if end < 0:
+                    break
+                pos = end + len(footer)
+                index.append([type_, match.start(), pos - match.start()])
+
+        return index
+
+    def save(self):
+        """ Persist the index beside the file, atomically.
+        """
+        blob = json.dumps({'stamp': self.stamp, 'blocks': self.index}).encode('utf8')
+        write_atomic(self.index_path, blob, os.path.dirname(os.path.abspath(self.index_path)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return Block(self.path, *self.index[i])
+
+    def blocks(self, type=None):
+        """ Block handles, optionally of one type only.
+        """
+        return [Block(self.path, *entry) for entry in self.index if type in [None, entry[0]]]
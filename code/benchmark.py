@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+""" Benchmarks for the pfse, armor and diffie_hellman hot paths.
+
+    Every result is a JSON record on its own line, tagged with the commit
+    it was measured at, so runs can be saved and compared across commits.
+    URL ingredients are served by a local HTTP server (with Range support),
+    nothing leaves the machine.
+
+    SYNOPSIS
+        ./benchmark.py -l
+        ./benchmark.py -o before.json
+        ./benchmark.py -o after.json -c before.json
+        ./benchmark.py -b xor -s 4K -s 2G
+        ./benchmark.py -b mutate_hash -m sha256 -m shake_256 -k 4K -k 1M
+"""
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import pfse
+from armor import armor, dearmor
+from diffie_hellman import DH, MODP14, MODP16, MODP18, hex2int
+
+
+KEY_SIZES = [4096]
+MESSAGE_SIZES = [4096, 1 << 20, 64 << 20]
+RECORD_SIZES = [100, 1024, 10240]
+RECORD_BYTES = 1 << 20  # Bytes of records encrypted per cipher measurement.
+FORMULAS = ['k(i+1) - k(i-1)', 'x*x + i', 'sin(x)*1000', 'x ** k(i)']
+GROUPS = {'modp14': MODP14, 'modp16': MODP16, 'modp18': MODP18}
+
+
+def measure(function, *args, nbytes=0, repeat=3):
+    """ Best-of-repeat wall time of function(*args), with throughput.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return {'seconds': best, 'mb_s': nbytes / best / 1e6 if best and nbytes else None}
+
+
+def random_bytes(size, seed=0):
+    """ Reproducible random bytes.
+    """
+    return np.random.default_rng(seed).integers(0, 256, size, dtype=np.uint8)
+
+
+def random_file(path, size, seed=0, chunk=64 << 20):
+    """ Write a reproducible random file, chunk by chunk.
+    """
+    rng = np.random.default_rng(seed)
+    with open(path, 'wb') as fh:
+        for offset in range(0, size, chunk):
+            fh.write(rng.integers(0, 256, min(chunk, size - offset), dtype=np.uint8).tobytes())
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """ Static file handler that honours single Range requests.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def send_head(self):
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+
+        length = os.path.getsize(path)
+        start = int(match.group(1))
+        stop = min(int(match.group(2) or length - 1), length - 1) + 1
+        if start >= length:
+            self.send_error(416)
+            return None
+
+        fh = open(path, 'rb')
+        fh.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{stop - 1}/{length}')
+        self.send_header('Content-Length', str(stop - start))
+        self.end_headers()
+        return LimitedReader(fh, stop - start)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LimitedReader(object):
+    """ File wrapper that stops after n bytes, for copyfile.
+    """
+    def __init__(self, fh, n):
+        self.fh = fh
+        self.n = n
+
+    def read(self, size=-1):
+        size = self.n if size < 0 else min(size, self.n)
+        blob = self.fh.read(size)
+        self.n -= len(blob)
+        return blob
+
+    def close(self):
+        self.fh.close()
+
+
+@contextlib.contextmanager
+def http_server(directory):
+    """ Serve a directory on localhost, yield its base URL.
+    """
+    handler = functools.partial(RangeHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_pad(args):
+    """ pad a short key up to each key size.
+    """
+    key = random_bytes(100)
+    for size in args.key_sizes:
+        yield dict(size=size, **measure(pfse.pad, key, size, nbytes=size, repeat=args.repeat))
+
+
+def bench_mutate_hash(args):
+    """ mutate_hash throughput per method and key size.
+    """
+    for size in args.key_sizes:
+        key = random_bytes(size)
+        for method in args.methods:
+            yield dict(method=method, size=size, **measure(pfse.mutate_hash, key, method, nbytes=size, repeat=args.repeat))
+
+
+def bench_mutate_formula(args):
+    """ mutate_formula, vectorized and per byte, per formula and key size.
+    """
+    for size in args.key_sizes:
+        key = random_bytes(size)
+        for formula in FORMULAS:
+            for vectorize in [True, False]:
+                if not vectorize and size > 65536:
+                    continue
+                result = measure(pfse.mutate_formula, key, formula, vectorize, nbytes=size, repeat=args.repeat)
+                yield dict(formula=formula, vectorize=vectorize, size=size, **result)
+
+
+def bench_xor(args):
+    """ xor and xor_pipelined on a file on disk, cyclic key and keystream, per message size.
+    """
+    key = random_bytes(pfse.SIZE)
+    with tempfile.TemporaryDirectory() as tmp:
+        path, out = os.path.join(tmp, 'message'), os.path.join(tmp, 'message.enc')
+        for size in args.message_sizes:
+            random_file(path, size)
+            for mode in ['cyclic', 'stream']:
+                if mode in ['stream'] and size > (64 << 20):
+                    continue
+                for function in [pfse.xor, pfse.xor_pipelined]:
+
+                    def run():
+                        stream = pfse.Keystream(key, FORMULAS[0]) if mode in ['stream'] else key
+                        with open(path, 'rb') as input_, open(out, 'wb') as output:
+                            function(input_, output, stream)
+
+                    yield dict(mode=mode, function=function.__name__, size=size, **measure(run, nbytes=size, repeat=args.repeat))
+
+
+def bench_cipher(args):
+    """ Records per second, Cipher.encrypt and encrypt_many against xor on file objects.
+    """
+    key = random_bytes(pfse.SIZE)
+    cipher = pfse.Cipher(key)
+    for size in RECORD_SIZES:
+        records = [random_bytes(size, seed).tobytes() for seed in range(RECORD_BYTES // size)]
+        mixed = [record[:len(record) - seed % 17] for seed, record in enumerate(records)]
+
+        def files():
+            for record in records:
+                output = io.BytesIO()
+                pfse.xor(io.BytesIO(record), output, key)
+
+        for path, run in [
+            ('xor', files),
+            ('encrypt', lambda: [cipher.encrypt(record) for record in records]),
+            ('encrypt_many', lambda: cipher.encrypt_many(records)),
+            ('encrypt_many_mixed', lambda: cipher.encrypt_many(mixed)),
+        ]:
+            result = measure(run, nbytes=RECORD_BYTES, repeat=args.repeat)
+            yield dict(path=path, size=size, records_s=len(records) / result['seconds'], **result)
+
+
+def bench_bake(args):
+    """ bake a recipe with file, url and password ingredients.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ['a', 'b', 'c']:
+            random_file(os.path.join(tmp, name), 1 << 20, seed=ord(name))
+        with http_server(tmp) as url:
+            for rows in [['file'], ['url'], ['file', 'url', 'url'], ['password']]:
+                recipe = os.path.join(tmp, 'recipe.csv')
+                with open(recipe, 'w') as fh:
+                    for type_, name in zip(rows, ['a', 'b', 'c']):
+                        arg = {'file': os.path.join(tmp, name), 'url': url + name, 'password': 'benchmark'}[type_]
+                        fh.write(f'"{type_}","{arg}"\n')
+                for size in args.key_sizes:
+                    result = measure(pfse.bake, recipe, FORMULAS[0], size, nbytes=size, repeat=args.repeat)
+                    yield dict(recipe='+'.join(rows), size=size, **result)
+
+
+def bench_armor(args):
+    """ armor and dearmor per message size.
+    """
+    for size in args.message_sizes:
+        if size > (64 << 20):
+            continue
+        blob = random_bytes(size).tobytes()
+        text = armor(blob)
+        yield dict(function='armor', size=size, **measure(armor, blob, nbytes=size, repeat=args.repeat))
+        yield dict(function='dearmor', size=size, **measure(dearmor, text, nbytes=size, repeat=args.repeat))
+
+
+def bench_dh(args):
+    """ DH.generate_publickey per MODP group, with pow and with a FixedBase table.
+    """
+    for name, group in GROUPS.items():
+        for fixed_base in [False, True]:
+            dh = DH(p=hex2int(group), fixed_base=fixed_base)
+            dh.generate_secret()
+            result = measure(dh.generate_publickey, repeat=args.repeat)
+            yield dict(group=name, backend='table' if fixed_base else 'pow', **result)
+
+
+BENCHMARKS = {
+    'pad': bench_pad,
+    'mutate_hash': bench_mutate_hash,
+    'mutate_formula': bench_mutate_formula,
+    'xor': bench_xor,
+    'cipher': bench_cipher,
+    'bake': bench_bake,
+    'armor': bench_armor,
+    'dh': bench_dh,
+}
+
+
+def revision():
+    """ The git commit being measured, if any.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record_key(record):
+    """ The parameters identifying a record, for comparisons.
+    """
+    return tuple(sorted((k, v) for k, v in record.items() if k not in ['seconds', 'mb_s', 'records_s', 'commit', 'python', 'numpy']))
+
+
+def compare(baseline, records):
+    """ Print each record's speed-up over the matching baseline record.
+    """
+    with open(baseline, 'r') as fh:
+        before = {record_key(r): r for r in map(json.loads, fh) if r}
+
+    for record in records:
+        old = before.get(record_key(record))
+        if old:
+            params = ', '.join(f'{k}={v}' for k, v in record_key(record))
+            print(f'{old["seconds"] / record["seconds"]:8.2f}x  {params}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--benchmark', dest='benchmarks', action='append', choices=list(BENCHMARKS), help='benchmark to run, may be repeated [all]')
+    parser.add_argument('-l', '--list', dest='list', action='store_true', default=False, help='list the benchmarks')
+    parser.add_argument('-m', '--method', dest='methods', action='append', choices=pfse.METHODS, help='hash method, may be repeated [all]')
+    parser.add_argument('-k', '--key-size', dest='key_sizes', action='append', type=pfse.parse_size, help='key size, K/M/G suffixes allowed, may be repeated [4K]')
+    parser.add_argument('-s', '--message-size', dest='message_sizes', action='append', type=pfse.parse_size, help='message size, K/M/G suffixes allowed, may be repeated [4K, 1M, 64M]')
+    parser.add_argument('-r', '--repeat', dest='repeat', action='store', type=int, default=3, help='best of this many runs [%(default)s]')
+    parser.add_argument('-o', '--output', dest='output', action='store', type=str, default='', help='also write the JSON records to a file')
+    parser.add_argument('-c', '--compare', dest='compare', action='store', type=str, default='', help='print speed-ups over a previous output file')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, function in BENCHMARKS.items():
+            print(f'{name:16}{function.__doc__.strip()}')
+        sys.exit()
+
+    args.methods = args.methods or [method for method in pfse.METHODS if method not in ['null']]
+    args.key_sizes = args.key_sizes or KEY_SIZES
+    args.message_sizes = args.message_sizes or MESSAGE_SIZES
+
+    tags = {'commit': revision(), 'python': platform.python_version(), 'numpy': np.__version__}
+    output = open(args.output, 'w') if args.output else None
+    records = []
+    for name in args.benchmarks or list(BENCHMARKS):
+        for record in BENCHMARKS[name](args):
+            record = dict(benchmark=name, **record, **tags)
+            records.append(record)
+            for fh in [sys.stdout, output]:
+                if fh:
+                    fh.write(json.dumps(record) + '\n')
+                    fh.flush()
+
+    if output:
+        output.close()
+
+    if args.compare:
+        compare(args.compare, records)
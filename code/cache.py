@@ -0,0 +1,272 @@
+""" Content-addressed on-disk cache for recipe ingredients.
+
+    Ingredients are looked up by (type, arg, offset, size). The blobs are
+    stored once per content digest under objects/, an index maps lookup
+    keys to blobs along with the validators needed to tell whether the
+    source changed: ETag/Last-Modified for URLs, mtime/inode/size for files.
+    The least recently used entries are evicted once the cache grows past
+    its size limit.
+
+    Baked keys ("compiled recipes") are kept apart in a KeyStore, encrypted
+    under a master key.
+"""
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pfse')
+CACHE_SIZE = 256 * 1024 * 1024  # Default cache size limit, in bytes.
+KEYS_DIR = os.path.join(CACHE_DIR, 'keys')
+NONCE_SIZE = 16  # Random bytes mixed into the mask of every KeyStore entry.
+
+
+def file_validators(path):
+    """ Validators telling whether a file changed.
+    """
+    st = os.stat(path)
+    return {'mtime': st.st_mtime_ns, 'inode': st.st_ino, 'size': st.st_size}
+
+
+def url_validators(response):
+    """ Validators telling whether a web resource changed.
+    """
+    validators = {}
+    for header in ['ETag', 'Last-Modified']:
+        if header in response.headers:
+            validators[header] = response.headers[header]
+
+    return validators
+
+
+def conditional_headers(validators):
+    """ Request headers asking a web server to only send a changed resource.
+    """
+    headers = {}
+    if 'ETag' in validators:
+        headers['If-None-Match'] = validators['ETag']
+    if 'Last-Modified' in validators:
+        headers['If-Modified-Since'] = validators['Last-Modified']
+
+    return headers
+
+
+def parse_size(text):
+    """ Parse a size in bytes, with an optional K, M or G suffix.
+    """
+    text = str(text).strip().upper()
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if text[-1:] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
+def write_atomic(path, blob, directory):
+    """ Write a file atomically, via a temporary file in directory.
+    """
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(blob)
+    os.replace(tmp, path)
+
+
+class IngredientCache(object):
+    """ Size-bounded LRU cache of ingredient blobs.
+
+        In offline mode URL ingredients are served from the cache only,
+        without validation. The cache can be shared between threads.
+    """
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        self.index_path = os.path.join(path, 'index.json')
+        try:
+            with open(self.index_path, 'r') as fh:
+                self.index = json.load(fh)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(type_, arg, offset=0, size=0, spec=''):
+        """ Lookup key of an ingredient.
+        """
+        fields = [type_, arg, offset, size] + ([spec] if spec else [])
+        return hashlib.sha256(json.dumps(fields).encode('utf8')).hexdigest()
+
+    def object_path(self, digest):
+        """ Path of a cached blob.
+        """
+        return os.path.join(self.path, 'objects', digest)
+
+    def lookup(self, key):
+        """ Return (blob, validators) of a cached ingredient, or (None, None).
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None, None
+
+            try:
+                with open(self.object_path(entry['digest']), 'rb') as fh:
+                    blob = fh.read()
+            except OSError:
+                del self.index[key]
+                return None, None
+
+            return blob, entry['validators']
+
+    def hit(self, key):
+        """ Record a cache hit.
+        """
+        with self.lock:
+            self.hits += 1
+            self.index[key]['atime'] = time.time()
+            self.save()
+
+    def store(self, key, blob, validators):
+        """ Add or replace an ingredient and evict old ones if needed.
+        """
+        digest = hashlib.sha256(blob).hexdigest()
+        with self.lock:
+            self.misses += 1
+            path = self.object_path(digest)
+            if not os.path.exists(path):
+                self.write(path, blob)
+
+            self.index[key] = {'digest': digest, 'validators': validators, 'size': len(blob), 'atime': time.time()}
+            self.evict()
+            self.save()
+
+    def evict(self):
+        """ Drop least recently used entries until the cache fits.
+        """
+        sizes = {}
+        for entry in self.index.values():
+            sizes[entry['digest']] = entry['size']
+
+        total = sum(sizes.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['atime']):
+            if total <= self.max_size:
+                break
+            del self.index[key]
+            digest = entry['digest']
+            if all(e['digest'] != digest for e in self.index.values()):
+                total -= sizes[digest]
+                try:
+                    os.remove(self.object_path(digest))
+                except OSError:
+                    pass
+
+    def write(self, path, blob):
+        """ Write a file atomically.
+        """
+        write_atomic(path, blob, self.path)
+
+    def save(self):
+        """ Persist the index.
+        """
+        self.write(self.index_path, json.dumps(self.index).encode('utf8'))
+
+    def stats(self):
+        """ Hit/miss counters.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def fresh(stored, current):
+    """ Whether ingredient validators still match.
+
+        Both are lists of [type, arg, validators]. Validators of None were
+        not checked (offline), empty ones can not tell and never match.
+    """
+    if len(stored) != len(current):
+        return False
+
+    for (type_, arg, old), (new_type, new_arg, new) in zip(stored, current):
+        if (type_, arg) != (new_type, new_arg):
+            return False
+        if new is None:
+            continue
+        if not new or old != new:
+            return False
+
+    return True
+
+
+class KeyStore(object):
+    """ Baked keys, encrypted under a master key.
+
+        Entries are looked up by a recipe digest and hold the validators of
+        the recipe's file and url ingredients, so a key is only served while
+        none of them changed. Every entry is XORed with its own mask, drawn
+        from SHAKE-256 over the master key, the digest and a random nonce
+        stored with the entry (a re-stored entry gets a fresh nonce), and
+        authenticated with an HMAC; an entry made under another master key
+        is a miss.
+    """
+    def __init__(self, master, path=KEYS_DIR):
+        self.master = bytes(master)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, digest):
+        """ Path of an entry.
+        """
+        return os.path.join(self.path, digest + '.json')
+
+    def mask(self, digest, nonce, size):
+        """ The mask of an entry.
+        """
+        return hashlib.shake_256(self.master + bytes.fromhex(digest) + nonce).digest(size)
+
+    def mac(self, digest, nonce, key):
+        """ The HMAC of an entry.
+        """
+        return hmac.new(self.master, bytes.fromhex(digest) + nonce + key, 'sha256').hexdigest()
+
+    def crypt(self, digest, nonce, blob):
+        """ XOR blob with the mask of an entry.
+        """
+        mask = self.mask(digest, nonce, len(blob))
+        return (int.from_bytes(blob, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(len(blob), 'big')
+
+    def lookup(self, digest, validators):
+        """ Return the key bytes of an entry, or None.
+        """
+        try:
+            with open(self.entry_path(digest), 'r') as fh:
+                entry = json.load(fh)
+            nonce = bytes.fromhex(entry['nonce'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if not fresh(entry['validators'], validators):
+            return None
+
+        key = self.crypt(digest, nonce, bytes.fromhex(entry['key']))
+        if not hmac.compare_digest(entry['mac'], self.mac(digest, nonce, key)):
+            return None
+
+        return key
+
+    def store(self, digest, key, validators):
+        """ Add or replace an entry.
+        """
+        key = bytes(key)
+        nonce = os.urandom(NONCE_SIZE)
+        entry = {
+            'validators': validators,
+            'nonce': nonce.hex(),
+            'key': self.crypt(digest, nonce, key).hex(),
+            'mac': self.mac(digest, nonce, key),
+        }
+        write_atomic(self.entry_path(digest), json.dumps(entry).encode('utf8'), self.path)
@@ -1,29 +1,50 @@
+import numpy
 
 
+def vectorized(F):
+    """ Mark a mutation function as one that takes whole arrays of k and n.
+    """
+    F.vectorized = True
+    return F
+
+@vectorized
 def simple(k, n):
     """ Simple example function with no additional parameters.
     """
-    if (n % 2) == 0:
-        return((k + 3) % 255)
-    else:
-        return((k + 5) % 255)
+    return(numpy.where((n % 2) == 0, (k + 3) % 255, (k + 5) % 255))
 
+@vectorized
 def simplep(k, n, a, b):
     """ Simple example function with additional parameters.
     """
-    if (n % 2) == 0:
-        return((k + a) % 255)
-    else:
-        return((k + b) % 255)
+    return(numpy.where((n % 2) == 0, (k + a) % 255, (k + b) % 255))
 
-def memory(k, n, registers=[0,1,2,3,4,5,6,7]):
-    """ This is a secret ingredient with 8 bytes of memory. 
+class Memory(object):
+    """ This is a secret ingredient with 8 bytes of memory.
+
+        The registers are carried from one block to the next, blocks have
+        to be passed in order with consecutive n.
     """
-    index = n % 8
-    r = registers[index]
-    registers[index] = k
-    
-    if (n % 5 == 0):
-        return(r)
-    else:
-        return(k)
+    vectorized = True
+
+    def __init__(self, registers=(0, 1, 2, 3, 4, 5, 6, 7)):
+        self.registers = numpy.array(registers, dtype=numpy.int64)
+
+    def __call__(self, k, n):
+        scalar = numpy.ndim(k) == 0
+        k = numpy.atleast_1d(numpy.asarray(k, dtype=numpy.int64))
+        n = numpy.atleast_1d(numpy.asarray(n, dtype=numpy.int64))
+        m = len(k)
+
+        # history[j] is the register value written at n[0] - 8 + j.
+        before = (n[0] - 8 + numpy.arange(8)) % 8
+        history = numpy.concatenate([self.registers[before], k])
+        r = history[:m]
+        self.registers[(n[0] + m - 8 + numpy.arange(8)) % 8] = history[-8:]
+
+        o = numpy.where(n % 5 == 0, r, k)
+        if scalar:
+            return(int(o[0]))
+        return(o)
+
+memory = Memory()
@@ -29,6 +29,7 @@ from StringIO import StringIO
 from optparse import OptionParser
 from subprocess import call
 from decimal import Decimal, InvalidOperation
+import numpy
 import psyco
 psyco.full()
 
@@ -81,24 +82,94 @@ def block_mutate_xor(input, output, keystream, F, data_ingredient=None, args=Non
                 output.write(''.join(o))
                 i = input.read(BLOCK_SIZE)
 
+def block_function(F, args=None):
+    """ Turn a mutation function into one over whole blocks, G(k, n),
+        where k and n are arrays.
 
-def circular_buffer(data):
-    """ A generator that sweeps circularly through the data buffer.
+        Functions marked vectorized (see catalog.vectorized) are called
+        with the arrays directly, any other function is called per byte.
     """
-    m = len(data)
-    index = 0
-    while True:
-        yield data[index]
-        index = (index + 1) % m
-
-def iters_demux(*iters):
-    """ Demultiplex multiple iterators.
+    args = args or ()
+
+    if getattr(F, 'vectorized', False):
+        def G(k, n):
+            return(F(k, n, *args))
+    else:
+        def G(k, n):
+            return(numpy.array([F(a, b, *args) for a, b in zip(k.tolist(), n.tolist())], dtype=numpy.int64))
+
+    return(G)
+
+def vector_mutate_xor(input, output, keystream, F, data_ingredient=None, args=None):
+    """ The same as block_mutate_xor, a block at a time with NumPy.
     """
-    m = len(iters)
-    index = 0
-    while True:
-        yield iters[index].next()
-        index = (index + 1) % m
+    G = block_function(F, args)
+    n = 0
+    i = input.read(BLOCK_SIZE)
+
+    while i:
+        m = len(i)
+        k = keystream.read(m).astype(numpy.int64)
+        o = numpy.frombuffer(i, dtype=numpy.uint8) ^ G(k, numpy.arange(n, n + m, dtype=numpy.int64))
+        if data_ingredient:
+            o ^= data_ingredient.read(m)
+        n += m
+
+        output.write(o.astype(numpy.uint8).tobytes())
+        i = input.read(BLOCK_SIZE)
+
+
+class Demux(object):
+    """ Demultiplex multiple data buffers, each swept circularly.
+
+        Byte t of the keystream is data_j[(t // m) % len(data_j)], where
+        j = t % m and m is the number of buffers. Any range of the
+        keystream is gathered into strided views, each the slice of its
+        buffer plus the wrapped head, no need to generate what comes
+        before it.
+    """
+    def __init__(self, *data):
+        self.data = [numpy.frombuffer(d, dtype=numpy.uint8) for d in data]
+        self.offset = 0
+
+    def __iter__(self):
+        return(self)
+
+    def range(self, offset, length):
+        """ Bytes [offset, offset+length) of the keystream, as an array.
+        """
+        m = len(self.data)
+        o = numpy.empty(length, dtype=numpy.uint8)
+        for j, data in enumerate(self.data):
+            p = (j - offset) % m
+            v = o[p::m]
+            q = (offset + p) // m % len(data)
+            h = min(len(v), len(data) - q)
+            v[:h] = data[q:q + h]
+            if len(v) > h:
+                v[h:] = numpy.resize(data, len(v) - h)
+
+        return(o)
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def read(self, length):
+        """ The next length bytes of the keystream, as an array.
+        """
+        o = self.range(self.offset, length)
+        self.offset += length
+        return(o)
+
+    def next(self):
+        """ The next byte of the keystream, as a character.
+        """
+        data = self.data[self.offset % len(self.data)]
+        q = self.offset // len(self.data) % len(data)
+        self.offset += 1
+        return(data[q:q + 1].tobytes())
+
+    __next__ = next
 
 def parse_parameters(params):
     """ Turn a comma-seperated string into a list of values.
@@ -125,12 +196,21 @@ def null(k, n):
     """
     return(k)
 
+null.vectorized = True
+
 if __name__ == '__main__':
 
     version = '%prog 1.1'
     parser = OptionParser(usage='%prog [options]',
                           version=version)
 
+    parser.add_option('-b',
+                      '--bytewise',
+                      dest='bytewise',
+                      action='store_true',
+                      default=False,
+                      help='mutate the keystream a byte at a time')
+
     parser.add_option('-c',
                       '--catalog',
                       dest='catalog',
@@ -271,7 +351,7 @@ if __name__ == '__main__':
                 if data:
                     # Note, error codes are deliberately not checked,
                     # thus a 404 page could be a valid ingredient. ;)
-                    ingredients.append(circular_buffer(data))
+                    ingredients.append(data)
 
     if not ingredients:
         print('A proper recipe is needed.')
@@ -283,7 +363,7 @@ if __name__ == '__main__':
 
     if options.data:
         try:
-            data_ingredient = circular_buffer(open(options.data, 'rb').read())
+            data_ingredient = Demux(open(options.data, 'rb').read())
         except IOError, error:
             print('Some issues with the data secret.')
             print(str(error))
@@ -332,10 +412,15 @@ if __name__ == '__main__':
         print('Function Secret: null(k, n)\n')
 
     # Intermediate keystream.
-    K_i = iters_demux(*ingredients)
+    K_i = Demux(*ingredients)
+
+    if options.bytewise:
+        mutate_xor = block_mutate_xor
+    else:
+        mutate_xor = vector_mutate_xor
 
     try:
-        block_mutate_xor(input, output, K_i, function_ingredient, data_ingredient, parameters)
+        mutate_xor(input, output, K_i, function_ingredient, data_ingredient, parameters)
     except TypeError, error:
         print('Problems with function, %s, parameters.' % options.function)
         print(str(error))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+""" Load generator for dh_server.py.
+
+    Runs a number of key exchanges against a server, concurrency at a time,
+    and reports handshakes per second and latency percentiles as JSON.
+
+    SYNOPSIS
+        ./dh_server.py -t 127.0.0.1:7000 -g modp14 &
+        ./dh_loadgen.py -t 127.0.0.1:7000 -g modp14 -n 200 -C 32
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import sys
+import time
+
+from diffie_hellman import GROUPS, hex2int
+from dh_server import add_arguments, exchange, parse_address
+
+
+def percentile(values, q):
+    """ The q-th percentile of sorted values, nearest rank.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+async def load(address, p, n, concurrency, executor, fixed_base=False):
+    """ Run n exchanges, concurrency at a time, return the report.
+    """
+    latencies = []
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors
+        async with limit:
+            start = time.perf_counter()
+            try:
+                await exchange(address, 2, p, executor, fixed_base)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(n)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'handshakes': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'handshakes_s': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('-n', '--number', dest='number', action='store', type=int, default=100, help='number of handshakes [%(default)s]')
+    parser.add_argument('-C', '--concurrency', dest='concurrency', action='store', type=int, default=16, help='concurrent clients [%(default)s]')
+    args = parser.parse_args()
+
+    if not (args.tcp or args.unix):
+        parser.print_help()
+        sys.exit()
+
+    p = hex2int(GROUPS[args.group])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        report = asyncio.run(load(parse_address(args), p, args.number, args.concurrency, executor, args.fixed_base))
+
+    report.update({'group': args.group, 'concurrency': args.concurrency})
+    print(json.dumps(report))
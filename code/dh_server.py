@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+""" Diffie-Hellman key exchange server and client over TCP or Unix sockets.
+
+    The client sends its ASCII armored dh-publickey block, the server
+    answers with its own, then both sides mix the private key. All modular
+    exponentiations run in a process pool, so the event loop never stalls
+    on a 4096/8192-bit pow, and at most limit handshakes are in progress
+    at a time.
+
+    SYNOPSIS
+        ./dh_server.py -u /tmp/dh.sock &
+        ./dh_server.py -u /tmp/dh.sock -c
+        ./dh_server.py -t 127.0.0.1:7000 -g modp14 --limit 128 &
+        ./dh_server.py -t 127.0.0.1:7000 -g modp14 -c
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import sys
+
+from armor import ARMOR_TYPES, dearmor
+from diffie_hellman import DH, GROUPS, bytes2int, generate_keypair, hex2int
+
+
+FOOTER = ARMOR_TYPES['dh-publickey'][1].encode('ascii')
+LIMIT = 64  # Default number of concurrent handshakes.
+
+
+async def read_publickey(reader, p):
+    """ Read an armored public key block, return its value.
+
+        Values outside 2..p-2 (0, 1 and p-1 force a trivial shared key) are
+        rejected.
+    """
+    text = await reader.readuntil(FOOTER)
+    for type_, blob in dearmor(text.decode('ascii')):
+        if type_ in ['dh-publickey']:
+            B = bytes2int(blob)
+            break
+    else:
+        raise ValueError('No DH public key received')
+
+    if not 2 <= B <= p - 2:
+        raise ValueError('Invalid DH public key')
+    return B
+
+
+async def keypair(executor, g, p, fixed_base=False):
+    """ A new (a, A) pair, computed in the executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, generate_keypair, g, p, fixed_base)
+
+
+async def mix(executor, B, a, p):
+    """ The private key pow(B, a, p), computed in the executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, pow, B, a, p)
+
+
+def armored(g, p, A):
+    """ Armored public key text, newline terminated.
+    """
+    dh = DH(g, p)
+    dh.A = A
+    return (dh.publickey() + '\n').encode('ascii')
+
+
+class DHServer(object):
+    """ Answer DH key exchanges, at most limit at a time.
+
+        on_key(privatekey, peername) is called with every mixed key.
+    """
+    def __init__(self, g=2, p=hex2int(GROUPS['modp16']), limit=LIMIT, executor=None, fixed_base=False, on_key=None):
+        self.g = g
+        self.p = p
+        self.limit = asyncio.Semaphore(limit)
+        self.executor = executor or concurrent.futures.ProcessPoolExecutor()
+        self.fixed_base = fixed_base
+        self.on_key = on_key
+        self.handshakes = 0
+
+    async def handle(self, reader, writer):
+        """ One key exchange.
+        """
+        try:
+            async with self.limit:
+                B = await read_publickey(reader, self.p)
+                a, A = await keypair(self.executor, self.g, self.p, self.fixed_base)
+                writer.write(armored(self.g, self.p, A))
+                await writer.drain()
+                privatekey = await mix(self.executor, B, a, self.p)
+                self.handshakes += 1
+                if self.on_key:
+                    self.on_key(privatekey, writer.get_extra_info('peername'))
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_tcp(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle, path)
+        async with server:
+            await server.serve_forever()
+
+
+async def connect(address):
+    """ Open a connection to host:port or a Unix socket path.
+    """
+    if isinstance(address, tuple):
+        return await asyncio.open_connection(*address)
+    return await asyncio.open_unix_connection(address)
+
+
+async def exchange(address, g=2, p=hex2int(GROUPS['modp16']), executor=None, fixed_base=False):
+    """ Client side of a key exchange, returns the private key.
+    """
+    a, A = await keypair(executor, g, p, fixed_base)
+    reader, writer = await connect(address)
+    try:
+        writer.write(armored(g, p, A))
+        await writer.drain()
+        B = await read_publickey(reader, p)
+    finally:
+        writer.close()
+
+    return await mix(executor, B, a, p)
+
+
+def parse_address(args):
+    """ (host, port) or a socket path from the command line.
+    """
+    if args.tcp:
+        host, port = args.tcp.rsplit(':', 1)
+        return host, int(port)
+    return args.unix
+
+
+def add_arguments(parser):
+    """ Arguments shared with the load generator.
+    """
+    parser.add_argument('-t', '--tcp', dest='tcp', action='store', type=str, default='', help='host:port')
+    parser.add_argument('-u', '--unix', dest='unix', action='store', type=str, default='', help='Unix socket path')
+    parser.add_argument('-g', '--group', dest='group', action='store', type=str, default='modp16', choices=list(GROUPS), help='MODP group [%(default)s]')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=None, help='worker processes [one per CPU]')
+    parser.add_argument('-f', '--fixed-base', dest='fixed_base', action='store_true', default=False, help='use precomputed fixed-base tables')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('-l', '--limit', dest='limit', action='store', type=int, default=LIMIT, help='concurrent handshakes [%(default)s]')
+    parser.add_argument('-c', '--client', dest='client', action='store_true', default=False, help='run one exchange as a client and print the private key')
+    args = parser.parse_args()
+
+    if not (args.tcp or args.unix):
+        parser.print_help()
+        sys.exit()
+
+    address = parse_address(args)
+    p = hex2int(GROUPS[args.group])
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+
+    try:
+        if args.client:
+            print(asyncio.run(exchange(address, 2, p, executor, args.fixed_base)))
+        else:
+            server = DHServer(2, p, args.limit, executor, args.fixed_base)
+            if args.tcp:
+                asyncio.run(server.serve_tcp(*address))
+            else:
+                asyncio.run(server.serve_unix(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(cancel_futures=True)
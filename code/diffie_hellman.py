@@ -5,8 +5,14 @@
     https://en.wikipedia.org/wiki/Diffie%E2%80%93Hellman_key_exchange
     https://www.youtube.com/watch?v=Yjrfm_oRO0w
 """
+import collections
+import concurrent.futures
+import hashlib
 import os
+import queue
 import random
+import tempfile
+import threading
 import time
 
 from armor import armor, dearmor
@@ -102,6 +108,13 @@ B1D510BD 7EE74D73 FAF36BC3 1ECFA268 359046F4 EB879F92
 """
 
 
+GROUPS = {
+    'modp14': MODP14,
+    'modp16': MODP16,
+    'modp18': MODP18,
+}
+
+
 def hex2int(hex):
     """ Convert a hex string into an integer.
     """
@@ -133,13 +146,117 @@ def urandom(n):
     return int.from_bytes(os.urandom(n), byteorder='big')
 
 
+WINDOW = 4  # Default fixed-base window, in bits.
+TABLE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pfse', 'dh')
+
+
+class FixedBase(object):
+    """ Fixed-base windowed exponentiation, pow(g, e, p) with a precomputed table.
+
+        For every w-bit window j of the exponent the table holds
+        g ** (d << (w * j)) % p for d = 1..2**w - 1, so exponentiation costs
+        one modular multiplication per non-zero window and no squarings.
+    """
+    tables = {}
+
+    def __init__(self, g, p, window=WINDOW, table=None):
+        self.g = g
+        self.p = p
+        self.window = window
+        self.rows = -(-p.bit_length() // window)
+        self.table = table or self.build()
+
+    def build(self):
+        """ Compute the table, row by row.
+        """
+        g, p, n = self.g, self.p, (1 << self.window) - 1
+        table = []
+        base = g % p
+        for _ in range(self.rows):
+            row = [base]
+            for _ in range(n - 1):
+                row.append(row[-1] * base % p)
+            table.append(row)
+            base = row[-1] * base % p
+
+        return table
+
+    def pow(self, e):
+        """ pow(self.g, e, self.p).
+        """
+        if e < 0 or e.bit_length() > self.rows * self.window:
+            return pow(self.g, e, self.p)
+
+        p, w, mask = self.p, self.window, (1 << self.window) - 1
+        r = 1
+        for row in self.table:
+            d = e & mask
+            if d:
+                r = r * row[d - 1] % p
+            e >>= w
+            if not e:
+                break
+
+        return r % p
+
+    def filename(self, path=TABLE_DIR):
+        """ Where the table of this (g, p, window) is cached.
+        """
+        name = hashlib.sha256(f'{self.g}:{self.p}:{self.window}'.encode('ascii')).hexdigest()[:32]
+        return os.path.join(path, name + '.tbl')
+
+    def save(self, path=TABLE_DIR):
+        """ Write the table as fixed-width big-endian integers.
+        """
+        os.makedirs(path, exist_ok=True)
+        width = (self.p.bit_length() + 7) // 8
+        fd, tmp = tempfile.mkstemp(dir=path)
+        with os.fdopen(fd, 'wb') as fh:
+            for row in self.table:
+                fh.write(b''.join(x.to_bytes(width, 'big') for x in row))
+        os.replace(tmp, self.filename(path))
+
+    @classmethod
+    def load(cls, g, p, window=WINDOW, path=TABLE_DIR):
+        """ Table for (g, p, window), from memory, from disk or built (and saved).
+        """
+        key = (g, p, window)
+        if key in cls.tables:
+            return cls.tables[key]
+
+        fixed = cls(g, p, window, table=[[]])
+        n = (1 << window) - 1
+        width = (p.bit_length() + 7) // 8
+        try:
+            with open(fixed.filename(path), 'rb') as fh:
+                blob = fh.read()
+        except OSError:
+            blob = b''
+
+        if len(blob) == fixed.rows * n * width:
+            fixed.table = [
+                [int.from_bytes(blob[(r * n + d) * width:(r * n + d + 1) * width], 'big') for d in range(n)]
+                for r in range(fixed.rows)
+            ]
+        else:
+            fixed.table = fixed.build()
+            try:
+                fixed.save(path)
+            except OSError:
+                pass
+
+        cls.tables[key] = fixed
+        return fixed
+
+
 class DH(object):
     """ Diffie-Hellman Key Exchange.
     """
-    def __init__(self, g=2, p=hex2int(MODP16)):
+    def __init__(self, g=2, p=hex2int(MODP16), fixed_base=False):
         self.g = g
         self.p = p
         self.q = (p - 1) // 2
+        self.fixed = FixedBase.load(g, p) if fixed_base else None
         self.a = None
         self.A = None
         self.B = None
@@ -154,7 +271,15 @@ class DH(object):
     def generate_publickey(self):
         """ Generate a public key for Alice.
         """
-        self.A = pow(self.g, self.a, self.p)
+        if self.fixed:
+            self.A = self.fixed.pow(self.a)
+        else:
+            self.A = pow(self.g, self.a, self.p)
+        return self.publickey()
+
+    def publickey(self):
+        """ Alice's current public key, ASCII armored.
+        """
         return armor(int2bytes(self.A), type='dh-publickey')
 
     def load_publickey(self, text):
@@ -172,6 +297,136 @@ class DH(object):
         return self.privatekey
 
 
+POOL_DEPTH = 8  # Default number of ready keypairs kept per group.
+
+
+def generate_keypair(g, p, fixed_base=False):
+    """ Generate a (secret, public key) pair, (a, A).
+    """
+    dh = DH(g, p, fixed_base)
+    dh.generate_secret()
+    dh.generate_publickey()
+    return dh.a, dh.A
+
+
+class DHKeyPool(object):
+    """ Pool of pre-generated DH keypairs, refilled by worker processes.
+
+        Up to depth (a, A) pairs per (g, p) group are kept ready, every
+        handed out pair is replaced in the background. Each pair is handed
+        out exactly once.
+
+        with DHKeyPool([(2, hex2int(MODP16))]) as pool:
+            alice = pool.dh(2, hex2int(MODP16))
+            text = alice.publickey()
+    """
+    def __init__(self, groups=((2, hex2int(MODP16)),), depth=POOL_DEPTH, workers=None, fixed_base=False):
+        self.depth = depth
+        self.fixed_base = fixed_base
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.ready = {}
+        self.counters = {}
+        for g, p in groups:
+            self.add_group(g, p)
+
+    def add_group(self, g, p):
+        """ Start keeping keypairs ready for a group.
+        """
+        with self.lock:
+            if (g, p) in self.ready:
+                return
+            self.ready[(g, p)] = queue.Queue()
+            self.counters[(g, p)] = collections.Counter()
+        self.refill(g, p)
+
+    def refill(self, g, p):
+        """ Submit enough jobs to bring the group back to depth.
+        """
+        with self.lock:
+            counter = self.counters[(g, p)]
+            missing = self.depth - self.ready[(g, p)].qsize() - counter['in_flight']
+            counter['in_flight'] += max(0, missing)
+
+        for _ in range(missing):
+            try:
+                future = self.executor.submit(generate_keypair, g, p, self.fixed_base)
+            except RuntimeError:
+                # Shut down.
+                return
+            future.add_done_callback(lambda future: self.done(g, p, future))
+
+    def done(self, g, p, future):
+        """ Collect a finished keypair.
+        """
+        with self.lock:
+            counter = self.counters[(g, p)]
+            counter['in_flight'] -= 1
+            if future.cancelled() or future.exception():
+                counter['failed'] += 1
+                return
+            counter['produced'] += 1
+            self.ready[(g, p)].put(future.result())
+
+    def get(self, g=2, p=hex2int(MODP16), timeout=None):
+        """ Hand out a keypair (a, A), waiting for one if the pool is empty.
+        """
+        self.add_group(g, p)
+        ready = self.ready[(g, p)]
+        try:
+            pair = ready.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                self.counters[(g, p)]['waits'] += 1
+            self.refill(g, p)
+            pair = ready.get(timeout=timeout)
+
+        with self.lock:
+            self.counters[(g, p)]['handed_out'] += 1
+        self.refill(g, p)
+        return pair
+
+    def dh(self, g=2, p=hex2int(MODP16), timeout=None):
+        """ A DH object with a pooled keypair.
+        """
+        dh = DH(g, p)
+        dh.a, dh.A = self.get(g, p, timeout)
+        return dh
+
+    def metrics(self):
+        """ Per group: pool depth, jobs in flight, pairs produced, handed out
+            and failed, gets that had to wait, and the refill rate (pairs/s).
+        """
+        elapsed = time.monotonic() - self.start
+        metrics = {}
+        with self.lock:
+            for (g, p), counter in self.counters.items():
+                name = f'{g}:{p.bit_length()}'
+                metrics[name] = {
+                    'depth': self.ready[(g, p)].qsize(),
+                    'in_flight': counter['in_flight'],
+                    'produced': counter['produced'],
+                    'handed_out': counter['handed_out'],
+                    'failed': counter['failed'],
+                    'waits': counter['waits'],
+                    'refill_rate': counter['produced'] / elapsed if elapsed else 0.0,
+                }
+
+        return metrics
+
+    def close(self):
+        """ Stop the workers, dropping pending jobs.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 if __name__ == '__main__':
 
     alice = DH()
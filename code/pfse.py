@@ -21,20 +21,50 @@
     [4] https://cryptobook.nakov.com/
 """
 import argparse
+import ast
+import concurrent.futures
+import contextlib
+import copy
 import csv
+import functools
+import getpass
 import hashlib
+import json
 import math
+import mmap
+import operator
 import os
+import queue
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 
 import numpy as np
 import requests
 import scrypt
 
+from armor import ArmorWriter, DearmorReader
+from cache import CACHE_DIR, CACHE_SIZE, KEYS_DIR, IngredientCache, KeyStore, conditional_headers, file_validators, parse_size, url_validators
+
 
 SIZE = 4096  # Default file read/write block size, in bytes.
+BATCH = 256  # Default number of keystream blocks generated at a time.
+BLOCK_SIZE = 4 * 1024 * 1024  # Default xor buffer size, in bytes.
+CHUNK = 16 * 1024 * 1024  # Default out-of-core baking chunk size, in bytes.
+DEPTH = 3  # Default number of buffers in flight in the xor pipeline.
+PREFIX = 64 * 1024  # Default length of the key precomputed by a Cipher, in bytes.
+STATUS = '.pfse-status.jsonl'  # Batch status manifest, in the output directory.
 USER_AGENT = 'Mozilla/5.0'
+TIMEOUT = (10, 60)  # HTTP connect and read timeouts, in seconds.
+WORKERS = 8  # Default number of ingredients fetched concurrently, per host.
+THREADS = os.cpu_count() or 1  # Default number of hashing threads.
+RANGE_CHUNK = 4 * 1024 * 1024  # Default byte range fetched per request, for large url ingredients.
+RANGE_WORKERS = 4  # Default number of concurrent range requests per url ingredient.
+RUN = 512  # Default bytes sampled per region of a file ingredient with a stride.
+MASTER_SALT = b'pfse compiled recipes'  # scrypt salt of the KeyStore master key.
 
 METHODS = [
     'null',
@@ -43,6 +73,8 @@ METHODS = [
     'sha1',
     'sha256',
     'sha512',
+    'blake2b',
+    'shake_256',
 ]
 
 
@@ -64,47 +96,406 @@ def pad(key, size=SIZE):
     return k
 
 
-def mutate_hash(key, method='sha256'):
+def cyclic(src, start, stop, out=None):
+    """ Bytes start..stop-1 of src repeated cyclically, in out if given.
+
+        Only the bytes needed are read, src may be an np.memmap larger
+        than memory.
+    """
+    n = len(src)
+    out = np.empty(stop - start, dtype=np.uint8) if out is None else out[:stop - start]
+    if n <= len(out):
+        out[:] = np.resize(np.roll(np.asarray(src), -(start % n)), len(out))
+        return out
+
+    pos = start
+    while pos < stop:
+        i = pos % n
+        m = min(n - i, stop - pos)
+        out[pos - start:pos - start + m] = src[i:i + m]
+        pos += m
+
+    return out
+
+
+def mutate_hash(key, method='sha256', threads=THREADS):
     """ Mutate a key into a new key using a given hash algorithm.
+
+        The output is written into a preallocated buffer. scrypt and blake2b
+        work in counter mode on independent blocks, scrypt blocks are hashed
+        by up to threads threads (scrypt releases the GIL). shake_256 is an
+        extendable-output function and produces the whole key in one call.
     """
     if method in ['null']:
         return key
 
     size = len(key)
-    src = pad(key, 2 * size).tobytes()
+
+    if method in ['shake_256']:
+        blob = hashlib.shake_256(pad(key, size).tobytes()).digest(size)
+        return np.frombuffer(bytearray(blob), dtype=np.uint8)
+
+    src = memoryview(pad(key, 2 * size).tobytes())
+    out = bytearray(size)
+
+    def write(digests, dsize):
+        for j, digest in enumerate(digests):
+            pos = j * dsize
+            out[pos:pos + dsize] = digest[:size - pos]
 
     if method in ['scrypt']:
         hash_ = scrypt.hash
 
         psize = min(64, size)
-        salt = src[:psize]
+        salt = src[:psize].tobytes()
         n = (size // psize) + 1
-        b = bytes()
-        i = 0
-        while len(b) < size:
-            part = src[i * psize:(i + 1) * psize]
-            i = (i + 1) % n
-            b += hash_(part, salt)
+        parts = [src[(j % n) * psize:((j % n) + 1) * psize].tobytes() for j in range(-(-size // 64))]
+        if threads > 1 and len(parts) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                write(executor.map(charged(lambda part: hash_(part, salt)), parts), 64)
+        else:
+            write((hash_(part, salt) for part in parts), 64)
+
+        return np.frombuffer(out, dtype=np.uint8)
 
-        return np.frombuffer(b, dtype=np.uint8, count=size)
+    if method in ['blake2b']:
+        seed = hashlib.blake2b(src).digest()
+        write((hashlib.blake2b(j.to_bytes(16, 'little'), key=seed).digest() for j in range(-(-size // 64))), 64)
+
+        return np.frombuffer(out, dtype=np.uint8)
 
     if method in METHODS:
         hash_ = getattr(hashlib, method)()
 
-        psize = min(len(hash_.digest()), size)
+        psize = min(hash_.digest_size, size)
         n = (size // psize) + 1
-        b = bytes()
+        pos = 0
         i = 0
-        while len(b) < size:
+        while pos < size:
             part = src[i * psize:(i + 1) * psize]
             i = (i + 1) % n
             hash_.update(part)
-            b += hash_.digest()
+            digest = hash_.digest()
+            out[pos:pos + len(digest)] = digest[:size - pos]
+            pos += len(digest)
+
+        return np.frombuffer(out, dtype=np.uint8)
+
+
+# Integer intermediates of a vectorized formula must stay within this bound,
+# otherwise int64 arithmetic could silently overflow where Python would not.
+INT_LIMIT = 2 ** 62
+
+# math functions that always return a float, evaluated with np.frompyfunc so
+# the results are bit-for-bit those of the math module.
+FLOAT_FUNCTIONS = [name for name in [
+    'acos', 'acosh', 'asin', 'asinh', 'atan', 'atan2', 'atanh', 'cbrt',
+    'copysign', 'cos', 'cosh', 'degrees', 'erf', 'erfc', 'exp', 'exp2',
+    'expm1', 'fmod', 'gamma', 'hypot', 'ldexp', 'lgamma', 'log', 'log10',
+    'log1p', 'log2', 'pow', 'radians', 'remainder', 'sin', 'sinh', 'tan',
+    'tanh',
+] if hasattr(math, name)]
+
+
+class Unvectorizable(Exception):
+    """ A formula (or one of its values) can not be evaluated with NumPy.
+    """
+
+
+def _int(value, lo, hi):
+    """ Wrap an integer value with its bounds.
+    """
+    if lo < -INT_LIMIT or hi > INT_LIMIT:
+        raise Unvectorizable('integer overflow')
+    return value, 'int', lo, hi
+
+
+def _float(value):
+    """ Wrap a float value.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.astype(np.float64, copy=False)
+    return value, 'float', None, None
+
+
+def _as_float(term):
+    """ Convert a term's value to float, like Python does for mixed arithmetic.
+    """
+    value, kind, lo, hi = term
+    if kind == 'float':
+        return value
+    if isinstance(value, np.ndarray):
+        return value.astype(np.float64)
+    return float(value)
+
+
+def _pyfunc(function, *terms):
+    """ Evaluate a Python function element-wise as a float ufunc.
+    """
+    values = [_as_float(t) if t[1] == 'float' else t[0] for t in terms]
+    result = np.frompyfunc(function, len(terms), 1)(*values)
+    return _float(np.asarray(result, dtype=np.float64))
+
+
+def _nonzero(term):
+    """ Refuse to divide by a term that contains a zero.
+    """
+    if np.any(np.asarray(term[0]) == 0):
+        raise Unvectorizable('division by zero')
+
+
+def _bits(*terms):
+    """ Number of bits needed for the magnitude of integer terms.
+    """
+    return max(max(abs(t[2]), abs(t[3])).bit_length() for t in terms)
+
+
+def _cast(*terms, bounds=()):
+    """ Cast integer term values to the narrowest dtype that holds every bound.
+    """
+    m = max(abs(v) for v in list(bounds) + [v for t in terms for v in t[2:]])
+    dtype = np.int16 if m < 2 ** 15 else np.int32 if m < 2 ** 31 else np.int64
+    return [t[0].astype(dtype, copy=False) if isinstance(t[0], (np.ndarray, np.generic)) else t[0] for t in terms]
+
+
+def _binop(op, a, b):
+    """ Vectorized binary operation on two terms.
+    """
+    ints = a[1] == 'int' and b[1] == 'int'
+
+    if isinstance(op, ast.Add):
+        if ints:
+            lo, hi = a[2] + b[2], a[3] + b[3]
+            u, v = _cast(a, b, bounds=(lo, hi))
+            return _int(u + v, lo, hi)
+        return _float(_as_float(a) + _as_float(b))
+
+    if isinstance(op, ast.Sub):
+        if ints:
+            lo, hi = a[2] - b[3], a[3] - b[2]
+            u, v = _cast(a, b, bounds=(lo, hi))
+            return _int(u - v, lo, hi)
+        return _float(_as_float(a) - _as_float(b))
+
+    if isinstance(op, ast.Mult):
+        if ints:
+            corners = [a[2] * b[2], a[2] * b[3], a[3] * b[2], a[3] * b[3]]
+            u, v = _cast(a, b, bounds=corners)
+            return _int(u * v, min(corners), max(corners))
+        return _float(_as_float(a) * _as_float(b))
+
+    if isinstance(op, ast.Div):
+        _nonzero(b)
+        if ints and _bits(a, b) > 53:
+            raise Unvectorizable('inexact integer division')
+        return _float(_as_float(a) / _as_float(b))
+
+    if isinstance(op, (ast.FloorDiv, ast.Mod)):
+        _nonzero(b)
+        if not ints:
+            function = operator.floordiv if isinstance(op, ast.FloorDiv) else operator.mod
+            return _pyfunc(function, a, b)
+        if isinstance(op, ast.FloorDiv):
+            m = max(abs(a[2]), abs(a[3]))
+            u, v = _cast(a, b, bounds=(m,))
+            return _int(np.floor_divide(u, v), -m, m)
+        u, v = _cast(a, b)
+        return _int(np.mod(u, v), min(0, b[2] + 1), max(0, b[3] - 1))
+
+    if isinstance(op, ast.Pow):
+        if not ints or b[3] < 0:
+            return _pyfunc(operator.pow, a, b)
+        if b[2] < 0:
+            raise Unvectorizable('mixed int/float powers')
+        m = max(abs(a[2]), abs(a[3]))
+        if m.bit_length() * b[3] > 64:
+            raise Unvectorizable('integer overflow')
+        m = max(m, 1) ** b[3]
+        u, v = _cast(a, b, bounds=(m,))
+        return _int(np.power(u, v), -m, m)
+
+    if not ints:
+        raise Unvectorizable('bitwise operation on floats')
+
+    if isinstance(op, (ast.BitAnd, ast.BitOr, ast.BitXor)):
+        function = {ast.BitAnd: np.bitwise_and, ast.BitOr: np.bitwise_or, ast.BitXor: np.bitwise_xor}[type(op)]
+        m = 2 ** _bits(a, b)
+        lo = -m if min(a[2], b[2]) < 0 else 0
+        u, v = _cast(a, b, bounds=(lo, m - 1))
+        return _int(function(u, v), lo, m - 1)
+
+    if isinstance(op, (ast.LShift, ast.RShift)):
+        if b[2] < 0 or b[3] > 62:
+            raise Unvectorizable('shift count out of range')
+        if isinstance(op, ast.LShift):
+            function, shift = np.left_shift, operator.lshift
+        else:
+            function, shift = np.right_shift, operator.rshift
+        corners = [shift(u, v) for u in (a[2], a[3]) for v in (b[2], b[3])]
+        u, v = _cast(a, b, bounds=corners)
+        return _int(function(u, v), min(corners), max(corners))
+
+    raise Unvectorizable(f'operator: {type(op).__name__}')
+
+
+def _compile(node):
+    """ Compile an expression node into a function of an evaluation context.
+    """
+    if isinstance(node, ast.Constant):
+        value = node.value
+        if isinstance(value, (bool, int)):
+            return lambda ctx: _int(int(value), int(value), int(value))
+        if isinstance(value, float):
+            return lambda ctx: _float(value)
+
+    elif isinstance(node, ast.Name):
+        name = node.id
+        if name in ['x', 'i', 'n']:
+            return lambda ctx: ctx[name]
+        if isinstance(getattr(math, name, None), float):
+            value = getattr(math, name)
+            return lambda ctx: _float(value)
+
+    elif isinstance(node, ast.UnaryOp):
+        operand = _compile(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.USub):
+            def usub(ctx):
+                term = value, kind, lo, hi = operand(ctx)
+                if kind == 'float':
+                    return _float(-value)
+                return _int(-_cast(term, bounds=(-lo,))[0], -hi, -lo)
+            return usub
+        if isinstance(node.op, ast.Invert):
+            def invert(ctx):
+                term = value, kind, lo, hi = operand(ctx)
+                if kind == 'float':
+                    raise Unvectorizable('bitwise operation on floats')
+                return _int(~_cast(term, bounds=(-hi - 1,))[0], -hi - 1, -lo - 1)
+            return invert
+
+    elif isinstance(node, ast.BinOp):
+        left, right, op = _compile(node.left), _compile(node.right), node.op
+        return lambda ctx: _binop(op, left(ctx), right(ctx))
+
+    elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        name = node.func.id
+        args = [_compile(arg) for arg in node.args]
+
+        if name == 'k' and len(args) == 1:
+            def k(ctx):
+                value, kind, lo, hi = args[0](ctx)
+                if kind == 'float':
+                    raise Unvectorizable('float key index')
+                src, shape = ctx['src'], ctx['x'][0].shape
+                n = src.shape[-1]
+                index = value if 0 <= lo and hi < n else np.mod(value, n)
+                if np.ndim(index) <= 1:
+                    k = np.broadcast_to(src[..., index], shape)
+                else:
+                    k = np.take_along_axis(src, np.broadcast_to(index, shape), axis=-1)
+                return _int(k.astype(np.int16), 0, 255)
+            return k
+
+        if name == 'abs' and len(args) == 1:
+            def abs_(ctx):
+                term = value, kind, lo, hi = args[0](ctx)
+                if kind == 'float':
+                    return _float(np.abs(value))
+                if lo >= 0:
+                    return term
+                value = np.abs(_cast(term, bounds=(-lo,))[0])
+                return _int(value, max(0, -hi), max(-lo, hi))
+            return abs_
+
+        if name in ['floor', 'ceil', 'trunc'] and len(args) == 1:
+            function = getattr(np, name)
+            def rounding(ctx):
+                term = args[0](ctx)
+                if term[1] == 'int':
+                    return term
+                value = np.asarray(function(term[0]))
+                if not np.all(np.abs(value) < INT_LIMIT):
+                    raise Unvectorizable('integer overflow')
+                value = value.astype(np.int64)
+                return _int(value, int(value.min(initial=0)), int(value.max(initial=0)))
+            return rounding
+
+        if name in ['sqrt', 'fabs'] and len(args) == 1:
+            function = getattr(np, name)
+            def native(ctx):
+                term = args[0](ctx)
+                if name == 'sqrt' and np.any(np.asarray(term[0]) < 0):
+                    raise Unvectorizable('math domain error')
+                return _float(function(_as_float(term)))
+            return native
+
+        if name in FLOAT_FUNCTIONS:
+            function = getattr(math, name)
+            return lambda ctx: _pyfunc(function, *[arg(ctx) for arg in args])
+
+    raise Unvectorizable(f'expression: {ast.dump(node)}')
+
+
+@functools.lru_cache(maxsize=64)
+def compile_formula(formula):
+    """ Compile a formula into a function evaluated over whole key arrays.
+
+        Raises Unvectorizable (or SyntaxError) when the formula uses
+        anything the NumPy compiler does not understand.
+    """
+    return _compile(ast.parse(formula.strip(), mode='eval').body)
+
+
+def evaluate_formula(function, src, start=0, stop=None):
+    """ Evaluate a compiled formula for positions start..stop-1 of src.
+
+        src may be a 2D array of keys, one per row, in which case every row
+        is mutated independently. Returns the formula values modulo 256.
+    """
+    n = src.shape[-1]
+    stop = n if stop is None else stop
+    x = np.asarray(src[..., start:stop]).astype(np.int16)
+    ctx = {
+        'src': src,
+        'x': _int(x, 0, 255),
+        'i': _int(np.arange(start, stop, dtype=np.int64), start, max(start, stop - 1)),
+        'n': _int(n, n, n),
+    }
+
+    with np.errstate(all='ignore'):
+        value, kind, lo, hi = function(ctx)
+        if kind == 'float':
+            if not np.all(np.isfinite(value)):
+                raise Unvectorizable('non-finite result')
+            value = np.trunc(value)
+            k = np.mod(np.broadcast_to(value, x.shape), 256).astype(np.uint8)
+        else:
+            # Integer casts wrap, the low byte is the value modulo 256.
+            k = np.broadcast_to(value, x.shape).astype(np.uint8)
 
-        return np.frombuffer(b, dtype=np.uint8, count=size)
+    return k
+
+
+def scalar_formula(formula, src, start=0, stop=None):
+    """ Evaluate a formula once per position start..stop-1 of src, in
+        Python. Returns the formula values modulo 256.
+    """
+    n = len(src)
+    stop = n if stop is None else stop
+    code = compile(formula.lstrip(' \t'), '<formula>', 'eval')
+    k = bytearray(stop - start)
+    g = math.__dict__.copy()
+    g.update({'k': lambda i: int(src[i % n]), 'n': n})
+    for i in range(start, stop):
+        g.update({'i': i, 'x': int(src[i])})
+        k[i - start] = int(eval(code, g)) % 256
 
+    return np.frombuffer(k, dtype=np.uint8)
 
-def mutate_formula(key, formula):
+
+def mutate_formula(key, formula, vectorize=True, report=False):
     """ Mutate a key by applying a formula.
 
         All the functions and constants of the math module are available.
@@ -116,18 +507,26 @@ def mutate_formula(key, formula):
         k = lambda i: key[i % n]
 
         Example formula: 'k(i-1) + k(i+1)'
+
+        The formula is compiled and evaluated over the whole key with NumPy
+        when possible, otherwise (or with vectorize=False) it is evaluated
+        once per key byte. With report=True the path taken, 'vectorized' or
+        'scalar', is returned along with the key.
     """
     size = len(key)
     src = pad(key, size)
-    k = [0] * size
-    g = math.__dict__.copy()
-    g.update({'k': lambda i: int(src[i % size]), 'n': size})
-    for i, x in enumerate(src):
-        x = int(x)
-        g.update({'i': i, 'x': x})
-        k[i] = int(eval(formula, g)) % 256
 
-    return np.frombuffer(bytes(k), dtype=np.uint8, count=size) ^ src
+    if vectorize:
+        try:
+            k = evaluate_formula(compile_formula(formula), src)
+        except Exception:
+            pass
+        else:
+            key = k ^ src
+            return (key, 'vectorized') if report else key
+
+    key = scalar_formula(formula, src) ^ src
+    return (key, 'scalar') if report else key
 
 
 def gen_password_key(password, size=SIZE):
@@ -136,43 +535,766 @@ def gen_password_key(password, size=SIZE):
     return mutate_hash(pad(password, size=size), 'scrypt')
 
 
-def gen_file_key(path, size=SIZE):
+def password_chunk(password, start, stop, size=SIZE, threads=THREADS):
+    """ Bytes start..stop-1 of gen_password_key(password, size).
+
+        Only the scrypt blocks overlapping the range are hashed, by up to
+        threads threads.
+    """
+    if size < 64:
+        return gen_password_key(password, size)[start:stop]
+
+    src = pad(password, len(bytes(password, 'utf8')))
+    salt = cyclic(src, 0, 64).tobytes()
+    j0, j1 = start // 64, -(-stop // 64)
+    parts = np.empty(64 * (j1 - j0), dtype=np.uint8)
+    # The hashed key is cyclic in size, the last block wraps around.
+    m = min(64 * j1, size) - 64 * j0
+    cyclic(src, 64 * j0, 64 * j0 + m, parts)
+    cyclic(src, 0, len(parts) - m, parts[m:])
+
+    parts = [part.tobytes() for part in parts.reshape(-1, 64)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        blob = b''.join(executor.map(charged(lambda part: scrypt.hash(part, salt)), parts))
+
+    return np.frombuffer(blob, dtype=np.uint8)[start - 64 * j0:stop - 64 * j0]
+
+
+def parse_spec(spec, size=SIZE):
+    """ Parse a file ingredient spec, 'offset=1G,stride=64M,run=512', into
+        (offset, stride, run).
+
+        Every field is optional. run defaults to RUN with a stride, to size
+        without one, stride defaults to run.
+    """
+    fields = {}
+    for field in spec.split(','):
+        if field.strip():
+            name, _, value = field.partition('=')
+            name = name.strip()
+            if name not in ['offset', 'stride', 'run']:
+                raise ValueError(f'Unknown file ingredient spec field: {name}')
+            fields[name] = parse_size(value)
+
+    run = fields.get('run') or (RUN if fields.get('stride') else size)
+    return fields.get('offset', 0), fields.get('stride') or run, run
+
+
+def sample(src, offset, stride, run, start, stop):
+    """ Bytes start..stop-1 of the runs of run bytes of src at offset,
+        offset+stride, offset+2*stride, ..., wrapping around its end.
+
+        Only the pages holding those bytes are read when src is an
+        np.memmap.
+    """
+    if stride == run:
+        return cyclic(src, offset + start, offset + stop)
+
+    if run < 64:
+        j, r = np.divmod(np.arange(start, stop, dtype=np.int64), run)
+        return src[(offset + j * stride + r) % len(src)]
+
+    # Longer runs are copied a run at a time, no index array needed.
+    out = np.empty(stop - start, dtype=np.uint8)
+    pos = start
+    while pos < stop:
+        j, r = divmod(pos, run)
+        m = min(run - r, stop - pos)
+        i = offset + j * stride + r
+        cyclic(src, i, i + m, out[pos - start:])
+        pos += m
+
+    return out
+
+
+def gen_file_key(path, size=SIZE, cache=None, spec=''):
     """ Read key from a file..
+
+        Without a spec the key is the first size bytes of the file, with
+        one it is sampled from all over the file, see parse_spec and sample.
     """
-    with open(path, 'rb') as fh:
-        blob = fh.read(size)
+    if cache is not None:
+        key = cache.key('file', os.path.abspath(path), 0, size, spec)
+        validators = file_validators(path)
+        blob, cached = cache.lookup(key)
+        if blob is not None and cached == validators:
+            cache.hit(key)
+            return pad(blob, size=size)
+
+    if spec:
+        src = np.memmap(path, dtype=np.uint8, mode='r')
+        blob = sample(src, *parse_spec(spec, size), 0, size).tobytes()
+        del src
+    else:
+        with open(path, 'rb') as fh:
+            blob = fh.read(size)
+
+    if cache is not None:
+        cache.store(key, blob, validators)
 
     return pad(blob, size=size)
 
 
-def gen_url_key(url, offset=0, size=SIZE):
+def make_session(pool_size=WORKERS):
+    """ A keep-alive HTTP session with at most pool_size connections per host.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def gen_url_key(url, offset=0, size=SIZE, cache=None, session=None, timeout=TIMEOUT, chunk=RANGE_CHUNK, workers=RANGE_WORKERS):
     """ Obtain a key from an URL.
+
+        The body is streamed into a preallocated key buffer. Keys larger
+        than chunk are fetched as chunk byte ranges, up to workers at a
+        time. A server that ignores Range requests is read up to size bytes
+        and cut off there.
     """
+    first = min(size, chunk)
     headers = {
-        'Range': 'bytes={}-{}'.format(offset, offset + size),
+        'Range': 'bytes={}-{}'.format(offset, offset + first - 1),
         'User-Agent': USER_AGENT,
     }
-    response = requests.get(url, headers=headers, stream=True)
 
-    if response.status_code in [200, 206]:
-        return pad(response.content, size=size)
-    else:
-        # 404 + all others.
-        raise ValueError("Web Resource Unavailable")
+    blob = None
+    if cache is not None:
+        key = cache.key('url', url, offset, size)
+        blob, validators = cache.lookup(key)
+        if cache.offline:
+            if blob is None:
+                raise ValueError("Web Resource Not Cached")
+            cache.hit(key)
+            return pad(blob, size=size)
+        if blob is not None:
+            headers.update(conditional_headers(validators))
+
+    get = (session or requests).get
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    def stream(response, start, stop):
+        """ Read a response body into buffer[start:stop], return its length.
+        """
+        i = start
+        for part in response.iter_content(BLOCK_SIZE):
+            m = min(len(part), stop - i)
+            view[i:i + m] = part[:m]
+            i += m
+            if i >= stop:
+                break
+        return i - start
+
+    with get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code in [304] and blob is not None:
+            cache.hit(key)
+            return pad(blob, size=size)
+        elif response.status_code in [200]:
+            n = stream(response, 0, size)
+            ranges = []
+        elif response.status_code in [206]:
+            n = stream(response, 0, first)
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            stop = min(size, int(total) - offset) if total.isdigit() else size
+            ranges = [(start, min(start + chunk, stop)) for start in range(first, stop, chunk)] if n == first else []
+        else:
+            # 404 + all others.
+            raise ValueError("Web Resource Unavailable")
+        validators = url_validators(response)
+
+    def fetch(range_):
+        start, stop = range_
+        headers = {
+            'Range': 'bytes={}-{}'.format(offset + start, offset + stop - 1),
+            'User-Agent': USER_AGENT,
+        }
+        # Only accept ranges of the same version of the resource.
+        if 'ETag' in validators and not validators['ETag'].startswith('W/'):
+            headers['If-Range'] = validators['ETag']
+        elif 'Last-Modified' in validators:
+            headers['If-Range'] = validators['Last-Modified']
+        with get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code in [416]:
+                return 0
+            if response.status_code not in [206]:
+                raise ValueError("Web Resource Changed")
+            return stream(response, start, stop)
+
+    if ranges:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for (start, stop), m in zip(ranges, executor.map(charged(fetch), ranges)):
+                n = start + m
+                if m < stop - start:
+                    break
+
+    if not n:
+        raise ValueError("Web Resource Empty")
+
+    if cache is not None:
+        cache.store(key, bytes(view[:n]), validators)
+
+    if n == size:
+        return np.frombuffer(buffer, dtype=np.uint8)
+    return pad(bytes(view[:n]), size=size)
+
+
+def fetch_url(url, path, size=SIZE, session=None, timeout=TIMEOUT):
+    """ Stream the first size bytes of an URL into a file, the bytes
+        gen_url_key would pad into a key.
+    """
+    headers = {
+        'Range': 'bytes={}-{}'.format(0, size),
+        'User-Agent': USER_AGENT,
+    }
+
+    with (session or requests).get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code not in [200, 206]:
+            raise ValueError("Web Resource Unavailable")
+
+        n = 0
+        with open(path, 'wb') as fh:
+            for blob in response.iter_content(BLOCK_SIZE):
+                fh.write(blob[:size - n])
+                n += len(blob)
+                if n >= size:
+                    break
+
+
+class Keystream(object):
+    """ A size-unbounded keystream grown from a baked key.
+
+        The key is extended in counter mode: block j of the stream is
+        squeezed from SHAKE-256 over the key and the 8-byte counter j, one
+        hash call per block, the key being absorbed only once. Other hash
+        methods XOR the key with the (cyclically padded) counter and
+        re-mutate it through mutate_hash, which takes several calls per
+        block. Blocks are optionally re-mutated through mutate_formula.
+        Every block is different, so the stream never repeats the way a
+        cyclic key does. Blocks are generated a batch at a time, with the
+        formula evaluated over the whole batch at once.
+    """
+    def __init__(self, key, formula=None, method='shake_256', batch=BATCH):
+        self.key = pad(key, len(key))
+        self.formula = formula
+        self.method = method
+        self.batch = batch
+        self.bsize = len(self.key)
+        self.counter = 0
+        self.buffer = np.empty(0, dtype=np.uint8)
+        self.xof = hashlib.shake_256(self.key.tobytes())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Hash objects do not pickle, workers absorb the key themselves.
+        del state['xof']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.xof = hashlib.shake_256(self.key.tobytes())
+
+    def counters(self, start, count):
+        """ The key XORed with counters start..start+count-1, one per row.
+        """
+        j = np.arange(start, start + count, dtype='<u8')
+        c = j.view(np.uint8).reshape(count, 8)
+        return self.key ^ np.tile(c, (1, self.bsize // 8 + 1))[:, :self.bsize]
+
+    def squeeze(self, start, count):
+        """ SHAKE-256 blocks start..start+count-1, one per row.
+        """
+        out = bytearray(count * self.bsize)
+        view = memoryview(out)
+        for j in range(count):
+            xof = self.xof.copy()
+            xof.update((start + j).to_bytes(8, 'little'))
+            view[j * self.bsize:(j + 1) * self.bsize] = xof.digest(self.bsize)
+
+        return np.frombuffer(out, dtype=np.uint8).reshape(count, self.bsize)
+
+    def blocks(self, start, count):
+        """ Generate count consecutive keystream blocks, starting at block start.
+        """
+        if self.method in ['shake_256']:
+            src = self.squeeze(start, count)
+        else:
+            src = self.counters(start, count)
+            for row in src:
+                row[:] = mutate_hash(row, self.method)
+
+        if self.formula:
+            try:
+                k = evaluate_formula(compile_formula(self.formula), src)
+            except Exception:
+                for row in src:
+                    row[:] = mutate_formula(row, self.formula, vectorize=False)
+            else:
+                src ^= k
+
+        return src.reshape(-1)
+
+    def seek(self, offset):
+        """ Move to byte offset of the keystream, generating only its block.
+        """
+        self.counter, skip = divmod(offset, self.bsize)
+        self.buffer = self.blocks(self.counter, 1)[skip:]
+        self.counter += 1
+
+    def read(self, n, out=None):
+        """ Return the next n bytes of the keystream, in out if given.
+        """
+        out = np.empty(n, dtype=np.uint8) if out is None else out[:n]
+        i = 0
+        while i < n:
+            if not len(self.buffer):
+                self.buffer = self.blocks(self.counter, self.batch)
+                self.counter += self.batch
+            m = min(n - i, len(self.buffer))
+            out[i:i + m] = self.buffer[:m]
+            self.buffer = self.buffer[m:]
+            i += m
+
+        return out
+
+
+class CyclicKey(object):
+    """ A key that repeats every size bytes, read like a Keystream.
+
+        An np.memmap key (see bake_memmap) of at least size bytes is used
+        as is, it is read from disk rather than tiled in memory.
+    """
+    def __init__(self, key, size=SIZE, block_size=BLOCK_SIZE):
+        self.size = size
+        if isinstance(key, np.memmap) and len(key) >= size:
+            self.tiled = key[:size]
+        else:
+            self.tiled = pad(pad(key, size), size + block_size)
+        self.offset = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self.tiled, np.memmap):
+            # Workers map the key file themselves.
+            state['tiled'] = (self.tiled.filename, self.tiled.offset)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.tiled, tuple):
+            filename, offset = self.tiled
+            self.tiled = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=self.size)
+
+    def seek(self, offset):
+        """ Move to byte offset of the key.
+        """
+        self.offset = offset
+
+    def read(self, n, out=None):
+        """ Return the next n bytes of the key, as a view where possible.
+        """
+        i = self.offset % self.size
+        self.offset += n
+        if i + n <= len(self.tiled):
+            return self.tiled[i:i + n]
+
+        return cyclic(self.tiled[:self.size], i, i + n, out)
+
 
+class Cipher(object):
+    """ Encrypt/decrypt short in-memory records with a baked key.
 
-def xor(input_, output, key, size=SIZE):
+        Every record is XORed with the key from its start, as if it were a
+        file of its own, so pfse.py decrypts it with the same recipe. The
+        first prefix bytes of the key (cycled, or extended into a Keystream
+        when a formula is given) are computed once. encrypt_many XORs a
+        whole list of records in one vectorized operation. A Cipher holds
+        no mutable state and can be shared between threads.
+    """
+    def __init__(self, key, size=SIZE, formula=None, prefix=PREFIX):
+        self.key = key
+        self.size = size
+        self.formula = formula
+        self.stream = self.keystream(prefix)
+
+    def keystream(self, n):
+        """ The first n bytes of the key applied to a record.
+        """
+        if self.formula:
+            return Keystream(self.key, self.formula).read(n)
+        return cyclic(pad(self.key, self.size), 0, n)
+
+    def encrypt(self, blob):
+        """ Encrypt (or decrypt) one record.
+        """
+        n = len(blob)
+        key = self.stream[:n] if n <= len(self.stream) else self.keystream(n)
+        return (np.frombuffer(blob, dtype=np.uint8) ^ key).tobytes()
+
+    def encrypt_many(self, blobs):
+        """ Encrypt (or decrypt) a list of records.
+        """
+        lengths = [len(blob) for blob in blobs]
+        if not blobs or max(lengths) > len(self.stream):
+            return [self.encrypt(blob) for blob in blobs]
+
+        data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+        n = lengths[0]
+        if n and lengths.count(n) == len(lengths):
+            # Records of one length are rows of a matrix, the key broadcasts.
+            blob = (data.reshape(-1, n) ^ self.stream[:n]).tobytes()
+            return [blob[i:i + n] for i in range(0, len(blob), n)]
+
+        blob = (data ^ np.concatenate([self.stream[:n] for n in lengths])).tobytes()
+        out = []
+        i = 0
+        for n in lengths:
+            out.append(blob[i:i + n])
+            i += n
+        return out
+
+    decrypt = encrypt
+    decrypt_many = encrypt_many
+
+
+def readfull(input_, buffer):
+    """ Read into buffer until it is full or input_ is exhausted.
+    """
+    view = memoryview(buffer)
+    n = 0
+    while n < len(view):
+        if hasattr(input_, 'readinto'):
+            m = input_.readinto(view[n:])
+        else:
+            blob = input_.read(len(view) - n)
+            m = len(blob)
+            view[n:n + m] = blob
+        if not m:
+            break
+        n += m
+
+    return n
+
+
+def xor(input_, output, key, size=SIZE, block_size=BLOCK_SIZE):
     """ Bitwise XOR input_ with key and write to output.
+
+        key is either a cyclic key, repeating every size bytes, or a
+        Keystream. The data is processed in place in a single reused buffer
+        of block_size bytes. Returns the number of bytes written.
     """
-    key = pad(key, size)
-    block = np.frombuffer(input_.read(size), dtype=np.uint8)
-    bsize = block.shape[0]
+    if not isinstance(key, (Keystream, CyclicKey)):
+        key = CyclicKey(key, size, block_size)
+
+    buffer = bytearray(block_size)
+    block = np.frombuffer(buffer, dtype=np.uint8)
+    scratch = np.empty(block_size, dtype=np.uint8)
+    view = memoryview(buffer)
+
+    n = 0
+    bsize = readfull(input_, buffer)
+    while bsize > 0:
+        np.bitwise_xor(block[:bsize], key.read(bsize, scratch), out=block[:bsize])
+        output.write(view[:bsize])
+        n += bsize
+        bsize = readfull(input_, buffer)
+
+    return n
+
+
+def xor_pipelined(input_, output, key, size=SIZE, block_size=BLOCK_SIZE, depth=DEPTH):
+    """ Bitwise XOR input_ with key and write to output, reading, XORing
+        and writing concurrently.
+
+        A reader and a writer thread pass depth reusable buffers of
+        block_size bytes around through queues, the keystream and XOR
+        (NumPy releases the GIL) run on the calling thread, so I/O overlaps
+        with the XOR. input_ and output may be pipes. The output is that of
+        xor. Returns the number of bytes written.
+    """
+    if not isinstance(key, (Keystream, CyclicKey)):
+        key = CyclicKey(key, size, block_size)
+
+    # Only depth buffers ever circulate, so no queue holds more than that.
+    free, full, done = queue.Queue(), queue.Queue(), queue.Queue()
+    for _ in range(depth):
+        free.put(bytearray(block_size))
+    errors = []
+
+    def read():
+        try:
+            buffer = free.get()
+            while buffer is not None:
+                bsize = readfull(input_, buffer)
+                full.put((buffer, bsize))
+                if not bsize:
+                    break
+                buffer = free.get()
+        except BaseException as e:
+            errors.append(e)
+            full.put((None, 0))
+
+    def write():
+        buffer, bsize = done.get()
+        while bsize:
+            if not errors:
+                try:
+                    output.write(memoryview(buffer)[:bsize])
+                except BaseException as e:
+                    errors.append(e)
+            free.put(buffer)
+            buffer, bsize = done.get()
+
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    writer.start()
+
+    scratch = np.empty(block_size, dtype=np.uint8)
+    n = 0
+    try:
+        buffer, bsize = full.get()
+        while bsize and not errors:
+            block = np.frombuffer(buffer, dtype=np.uint8, count=bsize)
+            np.bitwise_xor(block, key.read(bsize, scratch), out=block)
+            done.put((buffer, bsize))
+            n += bsize
+            buffer, bsize = full.get()
+    finally:
+        done.put((None, 0))
+        writer.join()
+        free.put(None)
+
+    if errors:
+        raise errors[0]
+
+    reader.join()
+    return n
+
+
+def open_file(path, mode='rb'):
+    """ Open a file, '-' is stdin or stdout (left open).
+    """
+    if path in ['-']:
+        return contextlib.nullcontext(sys.stdin.buffer if 'r' in mode else sys.stdout.buffer)
+    return open(path, mode)
+
+
+def xor_range(input_, output, key, offset, length=None, size=SIZE, block_size=BLOCK_SIZE):
+    """ Bitwise XOR bytes offset..offset+length-1 of input_ with the
+        matching slice of key and write them to output.
+
+        input_ has to be seekable. Only the range is read and only its part
+        of the key is generated, so the cost does not depend on the offset
+        or on the size of input_. Without a length the range runs to the
+        end of input_. Returns the number of bytes written.
+    """
+    if not isinstance(key, (Keystream, CyclicKey)):
+        key = CyclicKey(key, size, block_size)
+
+    input_.seek(offset)
+    key.seek(offset)
+    remaining = float('inf') if length is None else length
+
+    buffer = bytearray(block_size)
+    block = np.frombuffer(buffer, dtype=np.uint8)
+    scratch = np.empty(block_size, dtype=np.uint8)
+    view = memoryview(buffer)
 
+    n = 0
+    bsize = readfull(input_, view[:min(block_size, remaining)])
     while bsize > 0:
-        # mutate key
-        output.write((block ^ key[:bsize]).tobytes())
-        block = np.frombuffer(input_.read(size), dtype=np.uint8)
-        bsize = block.shape[0]
+        np.bitwise_xor(block[:bsize], key.read(bsize, scratch), out=block[:bsize])
+        output.write(view[:bsize])
+        n += bsize
+        remaining -= bsize
+        bsize = readfull(input_, view[:min(block_size, remaining)])
+
+    return n
+
+
+def xor_inplace(path, key, size=SIZE, block_size=BLOCK_SIZE):
+    """ Bitwise XOR a file with key, in place.
+
+        The file is mapped one block_size window at a time, so memory use
+        stays flat however large the file is.
+    """
+    if not isinstance(key, (Keystream, CyclicKey)):
+        key = CyclicKey(key, size, block_size)
+
+    granularity = mmap.ALLOCATIONGRANULARITY
+    block_size = max(granularity, block_size // granularity * granularity)
+    scratch = np.empty(block_size, dtype=np.uint8)
+
+    with open(path, 'r+b') as fh:
+        length = os.fstat(fh.fileno()).st_size
+        for offset in range(0, length, block_size):
+            bsize = min(block_size, length - offset)
+            with mmap.mmap(fh.fileno(), bsize, offset=offset) as mm:
+                block = np.frombuffer(mm, dtype=np.uint8)
+                np.bitwise_xor(block, key.read(bsize, scratch), out=block)
+                del block
+                mm.flush()
+
+
+def _xor_segment(input_path, output_path, key, start, stop, block_size):
+    """ XOR bytes start..stop-1 of one file into another, at the same offsets.
+    """
+    key.seek(start)
+    buffer = bytearray(block_size)
+    block = np.frombuffer(buffer, dtype=np.uint8)
+    scratch = np.empty(block_size, dtype=np.uint8)
+    view = memoryview(buffer)
+
+    fd_in = os.open(input_path, os.O_RDONLY)
+    fd_out = os.open(output_path, os.O_WRONLY)
+    try:
+        offset = start
+        while offset < stop:
+            bsize = os.preadv(fd_in, [view[:min(block_size, stop - offset)]], offset)
+            if not bsize:
+                break
+            np.bitwise_xor(block[:bsize], key.read(bsize, scratch), out=block[:bsize])
+            offset += os.pwrite(fd_out, view[:bsize], offset)
+    finally:
+        os.close(fd_in)
+        os.close(fd_out)
+
+
+def xor_parallel(input_path, output_path, key, size=SIZE, block_size=BLOCK_SIZE, jobs=None):
+    """ Bitwise XOR a file with key using a pool of jobs processes.
+
+        The file is split into one segment per job, every worker seeks the
+        key to the start of its segment and writes its output with pwrite.
+        The output is identical to that of xor. input_path and output_path
+        may be the same file.
+    """
+    if not isinstance(key, (Keystream, CyclicKey)):
+        key = CyclicKey(key, size, block_size)
+
+    jobs = jobs or os.cpu_count()
+    length = os.stat(input_path).st_size
+    if not os.path.exists(output_path) or not os.path.samefile(input_path, output_path):
+        with open(output_path, 'wb') as fh:
+            fh.truncate(length)
+    if length == 0:
+        return
+
+    step = -(-length // jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_xor_segment, input_path, output_path, key, start, min(start + step, length), block_size)
+            for start in range(0, length, step)
+        ]
+        for future in futures:
+            future.result()
+
+
+def walk(root):
+    """ Paths of all the files under root, in a stable order.
+    """
+    paths = []
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            paths.append(os.path.join(directory, name))
+
+    return paths
+
+
+def read_manifest(path):
+    """ The paths listed in a manifest file, one per line.
+    """
+    with open(path, 'r') as fh:
+        return [line.rstrip('\n') for line in fh if line.strip()]
+
+
+def crypt_file(input_path, output_path, key, block_size=BLOCK_SIZE, armor=False, dearmor=False):
+    """ XOR one file into another, which is written atomically.
+    """
+    directory = os.path.dirname(output_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.pfse-')
+    try:
+        with open(input_path, 'rb') as input_, os.fdopen(fd, 'wb') as output:
+            if dearmor:
+                input_ = DearmorReader(input_, 'message')
+            if armor:
+                output = ArmorWriter(output, 'message')
+            xor(input_, output, key, block_size=block_size)
+            if armor:
+                output.close()
+        os.chmod(tmp, os.stat(input_path).st_mode & 0o777)
+        os.replace(tmp, output_path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def batch(paths, root, output_dir, new_key, block_size=BLOCK_SIZE, workers=WORKERS, status=None, armor=False, dearmor=False, digest=None):
+    """ XOR many files with the same baked key, mirroring root under
+        output_dir.
+
+        new_key() returns a fresh CyclicKey or Keystream for every file,
+        digest identifies that key. The files are spread over a pool of
+        workers threads. Every finished file is appended to status, a JSON
+        lines manifest (STATUS in output_dir by default). A file is skipped
+        when it was already done with the same size and mtime, the same key
+        digest and armor settings, and its output is still there unchanged,
+        so an interrupted run can be resumed. Returns the number of files
+        per status: done, skipped and error.
+    """
+    status = status or os.path.join(output_dir, STATUS)
+    os.makedirs(output_dir, exist_ok=True)
+    finished = {}
+    try:
+        with open(status, 'r') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A run interrupted mid-line.
+                    continue
+                finished[record['path']] = record
+    except OSError:
+        pass
+
+    def output_stat(output):
+        try:
+            st = os.stat(output)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def crypt(path):
+        record = {'path': os.path.relpath(path, root), 'digest': digest, 'armor': armor, 'dearmor': dearmor}
+        output = os.path.join(output_dir, record['path'])
+        try:
+            st = os.stat(path)
+            record.update({'size': st.st_size, 'mtime': st.st_mtime_ns})
+            old = finished.get(record['path'], {})
+            same = all(old.get(field) == record[field] for field in ['size', 'mtime', 'digest', 'armor', 'dearmor'])
+            if old.get('status') in ['done'] and same and old.get('output') == output_stat(output):
+                return dict(old, status='skipped')
+            crypt_file(path, output, new_key(), block_size, armor, dearmor)
+            record['output'] = output_stat(output)
+        except Exception as e:
+            return dict(record, status='error', error=str(e))
+
+        return dict(record, status='done')
+
+    counts = {'done': 0, 'skipped': 0, 'error': 0}
+    with open(status, 'a') as fh:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(crypt, path) for path in paths]):
+                record = future.result()
+                counts[record['status']] += 1
+                if record['status'] not in ['skipped']:
+                    fh.write(json.dumps(record) + '\n')
+                    fh.flush()
+
+    return counts
 
 
 LOOKUP = {
@@ -181,10 +1303,99 @@ LOOKUP = {
     'url': gen_url_key,
 }
 
-def bake(recipe, secret_ingredient, size=SIZE):
-    """ Make a key from a CSV recipe.
+CACHED = ['file', 'url']  # Ingredient types kept in an IngredientCache.
+
+_charge = threading.local()
+
+
+def charged(function):
+    """ Wrap function so the CPU time of its calls, made from a pool's
+        worker threads, is added to the thread=True phase of the calling
+        thread. function is returned as is outside of such a phase.
     """
-    ingredients = []
+    account = getattr(_charge, 'account', None)
+    if account is None:
+        return function
+
+    lock, total = account
+
+    def wrapper(*args, **kwargs):
+        cpu = time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with lock:
+                total[0] += time.thread_time() - cpu
+    return wrapper
+
+
+class Stats(object):
+    """ Per-phase wall and CPU times, bytes processed and peak memory.
+
+        with stats.phase('xor', bytes=n):
+            ...
+
+        Phases may be recorded from several threads, with thread=True their
+        CPU time is that of the calling thread plus that of the nested pool
+        work it hands out through charged(). Peak memory is tracked with
+        tracemalloc from the moment the Stats object is created.
+    """
+    def __init__(self, memory=True):
+        self.phases = []
+        self.memory = memory
+        if memory:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name, thread=False, **info):
+        """ Time a phase, info may be updated inside the with block.
+        """
+        clock = time.thread_time if thread else time.process_time
+        if thread:
+            outer = getattr(_charge, 'account', None)
+            _charge.account = (threading.Lock(), [0.0])
+        wall, cpu = time.perf_counter(), clock()
+        try:
+            yield info
+        finally:
+            cpu = clock() - cpu
+            if thread:
+                cpu += _charge.account[1][0]
+                _charge.account = outer
+            record = {'phase': name, 'wall': time.perf_counter() - wall, 'cpu': cpu}
+            record.update(info)
+            if 'bytes' in record and record['wall'] > 0:
+                record['mb_s'] = record['bytes'] / record['wall'] / 1e6
+            self.phases.append(record)
+
+    def report(self):
+        """ All recorded statistics.
+        """
+        report = {'phases': self.phases}
+        if self.memory and tracemalloc.is_tracing():
+            report['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def dump(self, path='-'):
+        """ Write the statistics as JSON to a file, or stderr for '-'.
+        """
+        if path in ['-']:
+            json.dump(self.report(), sys.stderr)
+            sys.stderr.write('\n')
+        else:
+            with open(path, 'w') as fh:
+                json.dump(self.report(), fh)
+                fh.write('\n')
+
+
+def read_recipe(recipe, cwd=None):
+    """ The (type, arg, spec) rows of a CSV recipe, without comments.
+
+        spec is the optional third column, '' when there is none. Relative
+        file ingredients are resolved against cwd, when given, instead of
+        the working directory.
+    """
+    rows = []
     with open(recipe, 'r') as fh:
         reader = csv.reader(fh)
         # header = next(reader)
@@ -194,55 +1405,392 @@ def bake(recipe, secret_ingredient, size=SIZE):
                 if type_ in ['comment']:
                     continue
                 arg = row[1]
+                if cwd is not None and type_ in ['file']:
+                    arg = os.path.join(cwd, arg)
+                rows.append((type_, arg, row[2] if len(row) > 2 else ''))
+
+    return rows
+
+
+def recipe_digest(recipe, secret, size=SIZE):
+    """ Digest identifying a baked key.
+    """
+    h = hashlib.sha256()
+    with open(recipe, 'rb') as fh:
+        h.update(hashlib.sha256(fh.read()).digest())
+    h.update(hashlib.sha256(secret.encode('utf8')).digest())
+    h.update(str(size).encode('ascii'))
+    return h.hexdigest()
+
+
+def recipe_validators(rows, offline=False, workers=WORKERS, timeout=TIMEOUT):
+    """ [type, arg, validators] of the file and url ingredients of a recipe.
+
+        url ingredients are checked with HEAD requests, concurrently, and
+        not at all when offline (their validators are None).
+    """
+    session = make_session(workers) if any(row[0] in ['url'] for row in rows) else None
+
+    def validate(row):
+        type_, arg, spec = row
+        if type_ in ['file']:
+            return ['file', os.path.abspath(arg), file_validators(arg)]
+        if offline:
+            return ['url', arg, None]
+        try:
+            response = session.head(arg, headers={'User-Agent': USER_AGENT}, allow_redirects=True, timeout=timeout)
+        except requests.RequestException:
+            return ['url', arg, {}]
+        return ['url', arg, url_validators(response) if response.ok else {}]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            return list(executor.map(validate, [row for row in rows if row[0] in CACHED]))
+        finally:
+            if session is not None:
+                session.close()
+
+
+def master_key(password, size=64):
+    """ Key protecting the compiled recipes in a KeyStore.
+
+        A single scrypt call, a hit has to cost less than the bake it skips.
+    """
+    return scrypt.hash(password, MASTER_SALT, buflen=size)
+
+
+def bake(recipe, secret_ingredient, size=SIZE, verbose=False, cache=None, workers=WORKERS, stats=None, range_chunk=RANGE_CHUNK, range_workers=RANGE_WORKERS, cwd=None):
+    """ Make a key from a CSV recipe.
+
+        The ingredients are fetched concurrently by up to workers threads,
+        url ingredients over a shared keep-alive session, in byte ranges of
+        range_chunk, up to range_workers at a time. file and url
+        ingredients are served from cache, an IngredientCache, when given.
+        Timings of every recipe row and phase are recorded in stats, a
+        Stats object, when given. Relative file ingredients are resolved
+        against cwd, when given.
+    """
+    stats = stats or Stats(memory=False)
+    rows = read_recipe(recipe, cwd)
+    session = make_session(workers) if any(row[0] in ['url'] for row in rows) else None
+
+    def fetch(row):
+        index, (type_, arg, spec) = row
+        kwargs = {}
+        if type_ in CACHED:
+            kwargs['cache'] = cache
+        if type_ in ['url']:
+            kwargs.update(session=session, chunk=range_chunk, workers=range_workers)
+        if spec:
+            if type_ not in ['file']:
+                raise ValueError(f'Only file ingredients take a spec: {type_}')
+            kwargs['spec'] = spec
+        # Never record passwords.
+        info = {'row': index, 'type': type_, 'bytes': size}
+        if type_ in CACHED:
+            info['arg'] = arg
+        if spec:
+            info['spec'] = spec
+        with stats.phase('ingredient', thread=True, **info):
+            return LOOKUP[type_](arg, size=size, **kwargs)
+
+    ingredients = []
+    with stats.phase('ingredients', rows=len(rows)):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for ingredient in executor.map(fetch, enumerate(rows)):
+                    ingredients.append(ingredient)
+            except Exception as e:
+                print(str(e), file=sys.stderr)
+                sys.exit(1)
+            finally:
+                if session is not None:
+                    session.close()
+
+    with stats.phase('combine', bytes=size):
+        key = ingredients[0]
+        for ingredient in ingredients[1:]:
+            key = key ^ ingredient
+
+    with stats.phase('mutate_formula', bytes=size) as info:
+        key, path = mutate_formula(key, secret_ingredient, report=True)
+        info['path'] = path
+    if verbose:
+        print(f'mutate_formula: {path}', file=sys.stderr)
+
+    return key
+
+
+def bake_compiled(recipe, secret_ingredient, password, size=SIZE, verbose=False, cache=None, workers=WORKERS, stats=None, range_chunk=RANGE_CHUNK, range_workers=RANGE_WORKERS, path=KEYS_DIR):
+    """ bake through the KeyStore of compiled recipes in path, under the
+        master key of password.
+
+        A stored key is returned as long as the recipe, secret and size are
+        the same and none of the file or url ingredients changed, skipping
+        the fetches, scrypt and the formula. Otherwise the recipe is baked
+        and stored. Returns (key, compiled).
+    """
+    stats = stats or Stats(memory=False)
+    digest = recipe_digest(recipe, secret_ingredient, size)
+    offline = cache is not None and cache.offline
+
+    with stats.phase('compiled') as info:
+        store = KeyStore(master_key(password), path)
+        validators = recipe_validators(read_recipe(recipe), offline, workers)
+        blob = store.lookup(digest, validators)
+        info['hit'] = blob is not None
+    if blob is not None:
+        return np.frombuffer(blob, dtype=np.uint8), True
+
+    key = bake(recipe, secret_ingredient, size, verbose, cache, workers, stats, range_chunk, range_workers)
+    store.store(digest, key.tobytes(), validators)
+    return key, False
+
+
+def bake_memmap(recipe, secret_ingredient, path, size=SIZE, chunk=CHUNK, verbose=False, workers=WORKERS, stats=None):
+    """ bake a key of any size into a file, out of core.
+
+        file and url ingredients are mapped from disk (url ingredients are
+        first streamed into a temporary file next to path), their XOR
+        combination is written to a temporary np.memmap and the formula is
+        evaluated over it, chunk bytes at a time, into path. Peak memory
+        depends on chunk, not on size. The key is the same as that of bake,
+        the ingredient cache is not used. Returns the key as a read-only
+        np.memmap, which xor takes as is.
+    """
+    stats = stats or Stats(memory=False)
+    rows = read_recipe(recipe)
+    chunk = -(-chunk // 64) * 64
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp:
+        session = make_session(workers) if any(row[0] in ['url'] for row in rows) else None
+
+        def fetch(row):
+            """ A function returning bytes start..stop-1 of an ingredient.
+            """
+            index, (type_, arg, spec) = row
+            if spec and type_ not in ['file']:
+                raise ValueError(f'Only file ingredients take a spec: {type_}')
+            if type_ in ['password']:
+                return lambda start, stop: password_chunk(arg, start, stop, size)
+            if type_ in ['url']:
+                local = os.path.join(tmp, str(index))
+                fetch_url(arg, local, size, session)
+                arg = local
+            elif type_ not in ['file']:
+                raise ValueError(f'Unknown ingredient type: {type_}')
+            if spec:
+                return functools.partial(sample, np.memmap(arg, dtype=np.uint8, mode='r'), *parse_spec(spec, size))
+            return functools.partial(cyclic, np.memmap(arg, dtype=np.uint8, mode='r')[:size])
+
+        with stats.phase('ingredients', rows=len(rows)):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
                 try:
-                    ingredients.append(LOOKUP[type_](arg, size=size))
+                    sources = list(executor.map(fetch, enumerate(rows)))
                 except Exception as e:
-                    print(str(e))
+                    print(str(e), file=sys.stderr)
                     sys.exit(1)
+                finally:
+                    if session is not None:
+                        session.close()
 
-    key = ingredients[0]
-    for ingredient in ingredients[1:]:
-        key = key ^ ingredient
+        combined = np.memmap(os.path.join(tmp, 'combined'), dtype=np.uint8, mode='w+', shape=size)
+        with stats.phase('combine', bytes=size):
+            for start in range(0, size, chunk):
+                stop = min(start + chunk, size)
+                block = combined[start:stop]
+                for j, source in enumerate(sources):
+                    part = source(start, stop)
+                    if j:
+                        block ^= part
+                    else:
+                        block[:] = part
 
-    return mutate_formula(key, secret_ingredient)
+        key = np.memmap(path, dtype=np.uint8, mode='w+', shape=size)
+        with stats.phase('mutate_formula', bytes=size) as info:
+            try:
+                function = compile_formula(secret_ingredient)
+            except Exception:
+                function = None
+
+            paths = set()
+            for start in range(0, size, chunk):
+                stop = min(start + chunk, size)
+                try:
+                    if function is None:
+                        raise Unvectorizable(secret_ingredient)
+                    k = evaluate_formula(function, combined, start, stop)
+                    paths.add('vectorized')
+                except Exception:
+                    k = scalar_formula(secret_ingredient, combined, start, stop)
+                    paths.add('scalar')
+                np.bitwise_xor(k, combined[start:stop], out=key[start:stop])
+
+            info['path'] = '+'.join(sorted(paths))
+
+        key.flush()
+        del key, combined, sources
+
+    if verbose:
+        print(f'mutate_formula: {info["path"]}', file=sys.stderr)
+
+    return np.memmap(path, dtype=np.uint8, mode='r')
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', dest='input', action='store', type=str, default='', help='input filename')
-    parser.add_argument('-o', '--output', dest='output', action='store', type=str, default='', help='output filename')
+    parser.add_argument('-i', '--input', dest='input', action='store', type=str, default='', help='input filename, - for stdin')
+    parser.add_argument('-o', '--output', dest='output', action='store', type=str, default='', help='output filename, - for stdout')
     parser.add_argument('-r', '--recipe', dest='recipe', action='store', type=str, default='recipe.csv', help='recipe filename [%(default)s]')
+    parser.add_argument('-m', '--mode', dest='mode', action='store', type=str, default='cyclic', choices=['cyclic', 'stream'], help='key mode, cycle the baked key or extend it into a keystream [%(default)s]')
     parser.add_argument('-s', '--secret', dest='secret', action='store', type=str, default='k(i+1) - k(i-1)', help='mutation formula, secret ingredient')
     parser.add_argument('-w', '--wipe', dest='wipe', action='store_true', default=False, help='securely wipe the input file')
+    parser.add_argument('-K', '--key-size', dest='key_size', action='store', type=parse_size, default=SIZE, help='baked key size in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--bake-to', dest='bake_to', action='store', type=str, default='', help='bake the key out of core into this file, for keys larger than memory')
+    parser.add_argument('--chunk', dest='chunk', action='store', type=parse_size, default=CHUNK, help='out-of-core baking chunk size in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('-b', '--block-size', dest='block_size', action='store', type=parse_size, default=BLOCK_SIZE, help='read/write block size in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--depth', dest='depth', action='store', type=int, default=DEPTH, help='buffers in flight between the reader, xor and writer threads, 1 for no threads [%(default)s]')
+    parser.add_argument('--in-place', dest='in_place', action='store_true', default=False, help='encrypt/decrypt the input file in place, no output file')
+    parser.add_argument('-a', '--armor', dest='armor', action='store_true', default=False, help='write ASCII armored output')
+    parser.add_argument('-d', '--dearmor', dest='dearmor', action='store_true', default=False, help='read ASCII armored input')
+    parser.add_argument('--offset', dest='offset', action='store', type=parse_size, default=0, help='only encrypt/decrypt from this byte offset on, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--length', dest='length', action='store', type=parse_size, default=None, help='only encrypt/decrypt this many bytes, K/M/G suffixes allowed [to the end]')
+    parser.add_argument('-j', '--jobs', dest='jobs', action='store', type=int, default=1, help='number of worker processes, 0 for one per CPU [%(default)s]')
+    parser.add_argument('-B', '--batch', dest='batch', action='store_true', default=False, help='the input is a directory, or a manifest listing one file per line, the output a directory mirroring it; -j threads')
+    parser.add_argument('--status', dest='status', action='store', type=str, default='', help=f'batch status manifest, finished files are skipped when resuming [OUTPUT/{STATUS}]')
+    parser.add_argument('-c', '--cache', dest='cache', action='store', type=str, nargs='?', const=CACHE_DIR, default='', help='cache file and url ingredients in a directory [%(const)s]')
+    parser.add_argument('--cache-size', dest='cache_size', action='store', type=parse_size, default=CACHE_SIZE, help='cache size limit in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--offline', dest='offline', action='store_true', default=False, help='serve url ingredients from the cache only')
+    parser.add_argument('--range-chunk', dest='range_chunk', action='store', type=parse_size, default=RANGE_CHUNK, help='byte range fetched per request for url ingredients, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--range-workers', dest='range_workers', action='store', type=int, default=RANGE_WORKERS, help='concurrent range requests per url ingredient [%(default)s]')
+    parser.add_argument('-k', '--compiled', dest='compiled', action='store', type=str, nargs='?', const=KEYS_DIR, default='', help='keep baked keys, encrypted under a master password ($PFSE_MASTER or prompted), in a directory [%(const)s]')
+    parser.add_argument('--stats', dest='stats', action='store', type=str, nargs='?', const='-', default='', help='write timings, throughput and peak memory as JSON to a file [stderr]')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='report which formula evaluation path was used')
     args = parser.parse_args()
 
-    input_ = open(args.input, 'rb')
-    output = open(args.output, 'wb')
     recipe = args.recipe
     secret = args.secret
+    mode = args.mode
     wipe = args.wipe
+    verbose = args.verbose
+    block_size = args.block_size
+    size = args.key_size
+    in_place = args.in_place
+    jobs = args.jobs
+    ranged = args.offset or args.length is not None
+    stats = Stats() if args.stats else None
+
+    cache = None
+    if args.cache or args.offline:
+        cache = IngredientCache(args.cache or CACHE_DIR, args.cache_size, args.offline)
 
-    if not (input_ and output and secret):
+    if not (args.input and (args.output or in_place) and secret):
         parser.print_help()
         sys.exit()
 
-    key = bake(recipe, secret)
+    if (args.armor or args.dearmor) and (in_place or (jobs != 1 and not args.batch)):
+        print('ASCII armor changes the size of the output, it can not be used with --in-place or --jobs.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.batch and ('-' in [args.input, args.output] or in_place or ranged or wipe):
+        print('Batch mode can not be used with stdin/stdout, --in-place, a byte range or --wipe.', file=sys.stderr)
+        sys.exit(1)
+
+    if '-' in [args.input, args.output] and (in_place or jobs != 1):
+        print('stdin/stdout can not be used with --in-place or --jobs.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.input in ['-'] and (ranged or wipe):
+        print('stdin can not be used with a byte range or --wipe.', file=sys.stderr)
+        sys.exit(1)
+
+    if ranged and (in_place or jobs != 1 or args.dearmor or wipe):
+        print('A byte range can not be used with --in-place, --jobs, --dearmor or --wipe.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.bake_to and (args.compiled or mode in ['stream']):
+        print('An out-of-core key can not be used with --compiled or -m stream.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.bake_to:
+        key = bake_memmap(recipe, secret, args.bake_to, size, args.chunk, verbose=verbose, stats=stats)
+    elif args.compiled:
+        password = os.environ.get('PFSE_MASTER') or getpass.getpass('Master password: ')
+        key, compiled = bake_compiled(recipe, secret, password, size, verbose=verbose, cache=cache, stats=stats, range_chunk=args.range_chunk, range_workers=args.range_workers, path=args.compiled)
+        if verbose:
+            print('key: {}'.format('compiled' if compiled else 'baked'), file=sys.stderr)
+    else:
+        key = bake(recipe, secret, size, verbose=verbose, cache=cache, stats=stats, range_chunk=args.range_chunk, range_workers=args.range_workers)
+    if cache is not None:
+        print('cache: {hits} hits, {misses} misses'.format(**cache.stats()), file=sys.stderr)
+
+    if args.batch:
+        if os.path.isdir(args.input):
+            root = args.input
+            output = os.path.abspath(args.output)
+            paths = [
+                path for path in walk(root)
+                if not os.path.abspath(path).startswith(output + os.sep) and os.path.basename(path) != STATUS
+            ]
+        else:
+            paths = read_manifest(args.input)
+            root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else '.'
+            paths = [os.path.abspath(path) for path in paths]
+
+        # The tiled key is shared, only the offset is per file.
+        cyclic_key = CyclicKey(key, size, block_size)
+
+        def new_key():
+            return Keystream(key, secret) if mode in ['stream'] else copy.copy(cyclic_key)
+
+        with (stats or Stats(memory=False)).phase('batch', files=len(paths), jobs=jobs) as info:
+            digest = '{}-{}'.format(recipe_digest(recipe, secret, size), mode)
+            counts = batch(paths, root, args.output, new_key, block_size, jobs or os.cpu_count(), args.status, args.armor, args.dearmor, digest)
+            info.update(counts)
+        print('batch: {done} done, {skipped} skipped, {error} errors'.format(**counts), file=sys.stderr)
+        if stats is not None:
+            stats.dump(args.stats)
+        sys.exit(1 if counts['error'] else 0)
+
+    if mode in ['stream']:
+        key = Keystream(key, secret)
+
+    length = None if args.input in ['-'] else os.path.getsize(args.input)
+    if ranged:
+        length = max(0, min(length - args.offset, length if args.length is None else args.length))
 
-    # Encrypt key with a master password.
-    # with open('key.txt', 'w') as fh:
-    #     master_key = mutate_hash(gen_password_key('password;)'), 'scrypt')
-    #     fh.write((key ^ master_key).tobytes().hex())
+    with (stats or Stats(memory=False)).phase('xor', mode=mode, jobs=jobs) as info:
+        if jobs != 1:
+            xor_parallel(args.input, args.input if in_place else args.output, key, size, block_size, jobs)
+        elif in_place:
+            xor_inplace(args.input, key, size, block_size)
+        else:
+            with open_file(args.input, 'rb') as input_, open_file(args.output, 'wb') as output:
+                if args.dearmor:
+                    input_ = DearmorReader(input_, 'message')
+                if args.armor:
+                    output = ArmorWriter(output, 'message')
+                if ranged:
+                    xor_range(input_, output, key, args.offset, args.length, size, block_size)
+                elif args.depth > 1:
+                    length = xor_pipelined(input_, output, key, size, block_size, args.depth)
+                else:
+                    length = xor(input_, output, key, size, block_size)
+                if args.armor:
+                    output.close()
+        info['bytes'] = length
 
-    xor(input_, output, key)
+    if stats is not None:
+        stats.dump(args.stats)
 
-    if wipe:
-        command = f'wipe {input_}'
+    if wipe and not in_place:
+        command = f'wipe {args.input}'
         try:
             subprocess.call(command, shell=True)
         except:
-            print('You need to install a secure-wipe utility, either')
-            print('http://lambda-diode.com/software/wipe/ or')
-            print('http://wipe.sourceforge.net/')
-            print('Make sure wipe is in your PATH.')
+            print('You need to install a secure-wipe utility, either', file=sys.stderr)
+            print('http://lambda-diode.com/software/wipe/ or', file=sys.stderr)
+            print('http://wipe.sourceforge.net/', file=sys.stderr)
+            print('Make sure wipe is in your PATH.', file=sys.stderr)
 
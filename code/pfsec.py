@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+""" Thin pfse client, encrypt/decrypt through a running pfsed daemon.
+
+    Takes the same flags as pfse.py, but leaves baking (and the NumPy,
+    requests and scrypt imports) to the daemon, so a run costs
+    milliseconds once the daemon has the key warm. ASCII armor is done on
+    the client. The flags that tune how the key is baked or the file is
+    processed locally (-c/--offline, -k, --bake-to, -j, -B, --depth and
+    the --range-* flags) have no client equivalent: the cache flags belong
+    to pfsed.py, the rest need the key in this process.
+
+    Protocol, over a Unix domain socket: the client sends a JSON header
+    line, then the input as frames, each a 4-byte big-endian length and
+    that many bytes, ending with an empty frame. The daemon answers with a
+    JSON status line, then the output frames in the same format.
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from armor import ArmorWriter, DearmorReader
+from cache import parse_size
+
+
+SOCKET = os.path.join(tempfile.gettempdir(), f'pfsed-{os.getuid()}.sock')
+FRAME = struct.Struct('>I')
+FRAME_SIZE = 1024 * 1024  # Default frame size, in bytes.
+
+
+def recvall(sock, n):
+    """ Receive exactly n bytes.
+    """
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    i = 0
+    while i < n:
+        m = sock.recv_into(view[i:])
+        if not m:
+            raise ConnectionError('pfsed closed the connection')
+        i += m
+
+    return buffer
+
+
+def send(sock, input_, frame_size=FRAME_SIZE, length=None):
+    """ Send a file, or its first length bytes, as frames.
+    """
+    buffer = bytearray(frame_size)
+    view = memoryview(buffer)
+    remaining = float('inf') if length is None else length
+    n = input_.readinto(view[:min(frame_size, remaining)])
+    while n:
+        sock.sendall(FRAME.pack(n))
+        sock.sendall(view[:n])
+        remaining -= n
+        n = input_.readinto(view[:min(frame_size, remaining)])
+    sock.sendall(FRAME.pack(0))
+
+
+def crypt(input_, output, recipe, secret, mode='cyclic', path=SOCKET, frame_size=FRAME_SIZE, size=None, offset=0, length=None):
+    """ Encrypt/decrypt input_ into output through the daemon.
+
+        With an offset input_ is read from there on, up to length bytes,
+        and XORed with the matching slice of the key. Returns the daemon's
+        status, along with the number of bytes and the timings of the key
+        and xor phases.
+    """
+    phases = []
+    wall, cpu = time.perf_counter(), time.process_time()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        header = {'recipe': os.path.abspath(recipe), 'cwd': os.getcwd(), 'secret': secret, 'mode': mode, 'size': size, 'offset': offset}
+        sock.sendall(json.dumps(header).encode('utf8') + b'\n')
+
+        status = bytearray()
+        while not status.endswith(b'\n'):
+            status += recvall(sock, 1)
+        status = json.loads(status)
+        if not status['ok']:
+            raise ValueError(status['error'])
+        phases.append({'phase': 'key', 'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu, 'cached': status['cached']})
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        if offset:
+            input_.seek(offset)
+        sender = threading.Thread(target=send, args=(sock, input_, frame_size, length), daemon=True)
+        sender.start()
+
+        total = 0
+        n, = FRAME.unpack(recvall(sock, FRAME.size))
+        while n:
+            output.write(recvall(sock, n))
+            total += n
+            n, = FRAME.unpack(recvall(sock, FRAME.size))
+
+        sender.join()
+
+    record = {'phase': 'xor', 'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu, 'mode': mode, 'bytes': total}
+    if record['wall'] > 0:
+        record['mb_s'] = total / record['wall'] / 1e6
+    phases.append(record)
+    status.update(bytes=total, phases=phases)
+
+    return status
+
+
+def dump_stats(phases, path='-'):
+    """ Write the phase timings as JSON to a file, or stderr for '-'.
+    """
+    report = json.dumps({'phases': phases}) + '\n'
+    if path in ['-']:
+        sys.stderr.write(report)
+    else:
+        with open(path, 'w') as fh:
+            fh.write(report)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', dest='input', action='store', type=str, default='', help='input filename, - for stdin')
+    parser.add_argument('-o', '--output', dest='output', action='store', type=str, default='', help='output filename, - for stdout')
+    parser.add_argument('-r', '--recipe', dest='recipe', action='store', type=str, default='recipe.csv', help='recipe filename [%(default)s]')
+    parser.add_argument('-m', '--mode', dest='mode', action='store', type=str, default='cyclic', choices=['cyclic', 'stream'], help='key mode, cycle the baked key or extend it into a keystream [%(default)s]')
+    parser.add_argument('-s', '--secret', dest='secret', action='store', type=str, default='k(i+1) - k(i-1)', help='mutation formula, secret ingredient')
+    parser.add_argument('-w', '--wipe', dest='wipe', action='store_true', default=False, help='securely wipe the input file')
+    parser.add_argument('-K', '--key-size', dest='key_size', action='store', type=parse_size, default=None, help="baked key size in bytes, K/M/G suffixes allowed [the daemon's]")
+    parser.add_argument('-b', '--block-size', dest='block_size', action='store', type=parse_size, default=FRAME_SIZE, help='frame size in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--in-place', dest='in_place', action='store_true', default=False, help='encrypt/decrypt the input file in place, no output file')
+    parser.add_argument('-a', '--armor', dest='armor', action='store_true', default=False, help='write ASCII armored output')
+    parser.add_argument('-d', '--dearmor', dest='dearmor', action='store_true', default=False, help='read ASCII armored input')
+    parser.add_argument('--offset', dest='offset', action='store', type=parse_size, default=0, help='only encrypt/decrypt from this byte offset on, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--length', dest='length', action='store', type=parse_size, default=None, help='only encrypt/decrypt this many bytes, K/M/G suffixes allowed [to the end]')
+    parser.add_argument('--stats', dest='stats', action='store', type=str, nargs='?', const='-', default='', help='write timings and throughput as JSON to a file [stderr]')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False, help='report whether the daemon had the key warm')
+    parser.add_argument('-S', '--socket', dest='socket', action='store', type=str, default=SOCKET, help='daemon socket [%(default)s]')
+    args = parser.parse_args()
+
+    if not (args.input and (args.output or args.in_place) and args.secret):
+        parser.print_help()
+        sys.exit()
+
+    ranged = args.offset or args.length is not None
+
+    if (args.armor or args.dearmor) and args.in_place:
+        print('ASCII armor changes the size of the output, it can not be used with --in-place.', file=sys.stderr)
+        sys.exit(1)
+
+    if ranged and (args.in_place or args.dearmor or args.wipe):
+        print('A byte range can not be used with --in-place, --dearmor or --wipe.', file=sys.stderr)
+        sys.exit(1)
+
+    if '-' in [args.input, args.output] and args.in_place:
+        print('stdin/stdout can not be used with --in-place.', file=sys.stderr)
+        sys.exit(1)
+
+    if args.input in ['-'] and (ranged or args.wipe):
+        print('stdin can not be used with a byte range or --wipe.', file=sys.stderr)
+        sys.exit(1)
+
+    input_ = sys.stdin.buffer if args.input in ['-'] else open(args.input, 'rb')
+    if args.in_place:
+        output = open(args.input, 'r+b')
+    else:
+        output = sys.stdout.buffer if args.output in ['-'] else open(args.output, 'wb')
+
+    error = None
+    try:
+        reader = DearmorReader(input_, 'message') if args.dearmor else input_
+        writer = ArmorWriter(output, 'message') if args.armor else output
+        status = crypt(reader, writer, args.recipe, args.secret, args.mode, args.socket, args.block_size, args.key_size, args.offset, args.length)
+        if args.armor:
+            writer.close()
+    except (OSError, ValueError) as e:
+        error = e
+    finally:
+        if input_ is not sys.stdin.buffer:
+            input_.close()
+        if output is sys.stdout.buffer:
+            output.flush()
+        else:
+            output.close()
+
+    if error is not None:
+        print(str(error), file=sys.stderr)
+        # Do not leave an empty or partial output behind.
+        if not args.in_place and output is not sys.stdout.buffer:
+            os.remove(args.output)
+        sys.exit(1)
+
+    if args.verbose:
+        print('key: {}'.format('warm' if status['cached'] else 'baked'), file=sys.stderr)
+
+    if args.stats:
+        dump_stats(status['phases'], args.stats)
+
+    if args.wipe and not args.in_place:
+        command = f'wipe {args.input}'
+        try:
+            subprocess.call(command, shell=True)
+        except:
+            print('You need to install a secure-wipe utility, either', file=sys.stderr)
+            print('http://lambda-diode.com/software/wipe/ or', file=sys.stderr)
+            print('http://wipe.sourceforge.net/', file=sys.stderr)
+            print('Make sure wipe is in your PATH.', file=sys.stderr)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+""" pfse daemon, keeps baked keys warm and serves encrypt/decrypt requests.
+
+    Baked keys are kept in an in-memory LRU keyed by a digest of the recipe
+    contents, the secret ingredient and the key size, so repeat requests
+    skip the ingredient fetches, scrypt and the formula mutation. Every
+    key is held along with the validators of the recipe's file and url
+    ingredients and baked again once any of them changed. Use pfsec.py as
+    the client, see there for the protocol.
+
+    SYNOPSIS
+        ./pfsed.py &
+        ./pfsec.py -r recipe.csv -s 'k(i-1) + k(i+1)' -i message.txt -o message.enc
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+
+import numpy as np
+
+from cache import CACHE_DIR, CACHE_SIZE, IngredientCache, fresh
+from pfse import SIZE, CyclicKey, Keystream, bake, parse_size, read_recipe, recipe_digest, recipe_validators
+from pfsec import FRAME, SOCKET
+
+
+KEYS = 16  # Default number of baked keys kept warm.
+
+
+def bake_key(recipe, secret, size=SIZE, cache=None, cwd=None):
+    """ bake, raising instead of exiting when an ingredient fails.
+    """
+    try:
+        return bake(recipe, secret, size, cache=cache, cwd=cwd)
+    except SystemExit:
+        raise ValueError(f'Unable to bake recipe: {recipe}')
+
+
+def xor_block(block, key):
+    """ XOR a block in place with the next bytes of key.
+    """
+    np.bitwise_xor(block, key.read(len(block)), out=block)
+
+
+class Daemon(object):
+    """ Serve encrypt/decrypt requests with an LRU of baked keys.
+    """
+    def __init__(self, keys=KEYS, size=SIZE, cache=None):
+        self.keys = collections.OrderedDict()
+        self.max_keys = keys
+        self.size = size
+        self.cache = cache
+
+    async def key(self, recipe, secret, cwd=None, size=None):
+        """ Return (key, cached) for a recipe, baking it on a miss or when
+            one of its file or url ingredients changed.
+
+            Relative file ingredients are resolved against cwd, the
+            client's working directory, which is part of the LRU key. size
+            defaults to the daemon's key size.
+        """
+        loop = asyncio.get_running_loop()
+        size = size or self.size
+        entry = (recipe_digest(recipe, secret, size), cwd)
+        offline = self.cache is not None and self.cache.offline
+        validators = await loop.run_in_executor(None, lambda: recipe_validators(read_recipe(recipe, cwd), offline))
+        cached = entry in self.keys and fresh(self.keys[entry][1], validators)
+        if not cached:
+            self.keys[entry] = (loop.run_in_executor(None, bake_key, recipe, secret, size, self.cache, cwd), validators)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        self.keys.move_to_end(entry)
+
+        try:
+            return await asyncio.shield(self.keys[entry][0]), cached
+        except BaseException:
+            self.keys.pop(entry, None)
+            raise
+
+    async def handle(self, reader, writer):
+        """ Serve one client connection.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            header = json.loads(await reader.readline())
+            size = header.get('size') or self.size
+            key, cached = await self.key(header['recipe'], header['secret'], header.get('cwd'), size)
+        except BaseException as e:
+            writer.write(json.dumps({'ok': False, 'error': str(e) or type(e).__name__}).encode('utf8') + b'\n')
+            await writer.drain()
+            writer.close()
+            return
+
+        if header.get('mode') in ['stream']:
+            key = Keystream(key, header['secret'])
+        else:
+            key = CyclicKey(key, size)
+        if header.get('offset'):
+            key.seek(header['offset'])
+
+        writer.write(json.dumps({'ok': True, 'cached': cached}).encode('utf8') + b'\n')
+        try:
+            n, = FRAME.unpack(await reader.readexactly(FRAME.size))
+            while n:
+                block = np.frombuffer(bytearray(await reader.readexactly(n)), dtype=np.uint8)
+                await loop.run_in_executor(None, xor_block, block, key)
+                writer.write(FRAME.pack(n))
+                writer.write(block.data)
+                await writer.drain()
+                n, = FRAME.unpack(await reader.readexactly(FRAME.size))
+
+            writer.write(FRAME.pack(0))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path=SOCKET):
+        """ Listen on a Unix domain socket, readable by this user only.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        os.chmod(path, 0o600)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--socket', dest='socket', action='store', type=str, default=SOCKET, help='socket to listen on [%(default)s]')
+    parser.add_argument('-k', '--keys', dest='keys', action='store', type=int, default=KEYS, help='number of baked keys kept warm [%(default)s]')
+    parser.add_argument('-c', '--cache', dest='cache', action='store', type=str, nargs='?', const=CACHE_DIR, default='', help='cache file and url ingredients in a directory [%(const)s]')
+    parser.add_argument('--cache-size', dest='cache_size', action='store', type=parse_size, default=CACHE_SIZE, help='cache size limit in bytes, K/M/G suffixes allowed [%(default)s]')
+    parser.add_argument('--offline', dest='offline', action='store_true', default=False, help='serve url ingredients from the cache only')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache or args.offline:
+        cache = IngredientCache(args.cache or CACHE_DIR, args.cache_size, args.offline)
+
+    try:
+        asyncio.run(Daemon(args.keys, cache=cache).serve(args.socket))
+    except KeyboardInterrupt:
+        sys.exit()